@@ -2,14 +2,31 @@
 # -*- coding: utf-8 -*-
 """cache.py
 
-simple caching using shelve/pickle.
+simple caching using SQLite/pickle (and Arrow for DataFrames).
 
 """
+import atexit
 import logging
 import os
-import shelve
+import pickle
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
 from glob import glob
 from hashlib import sha256
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+# requirements
+from pandas import DataFrame
+
+# optional: columnar storage of DataFrames
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
 
 logger = logging.getLogger(__name__)
 
@@ -36,15 +53,375 @@ def generate_library_idx(lib_path, prefix='', length=10):
     return generate_idx(identifiers, prefix, length)
 
 
+class MemoryCache:
+    """Process-wide LRU store of DataFrames in front of the on-disk
+    caches, bounded by number of entries and (estimated) bytes.
+
+    Entries are keyed by (database, key) and remember the creation
+    time of the corresponding disk entry; they are only used as long
+    as the disk entry still has this creation time (see Cache.get).
+    Times of access are collected in memory and saved to disk in
+    batches (see Cache.flush).
+
+    """
+
+    def __init__(self, max_entries=64, max_bytes=2**30):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (path, key) -> (created, value, nbytes)
+        self.accessed = dict()  # (path, key) -> time of last access (not saved yet)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def get(self, path, key, valid):
+        """Retrieve entry if still valid.
+
+        :param str path: path of database
+        :param str key: key of entry
+        :param callable valid: checks creation time of entry on disk
+
+        :return: value, None if not in memory or outdated
+        :rtype: DataFrame
+        """
+        with self.lock:
+            entry = self.entries.get((path, key))
+        if entry is not None and valid(entry[0]):
+            with self.lock:
+                if (path, key) in self.entries:
+                    self.entries.move_to_end((path, key))
+                self.accessed[(path, key)] = time()
+                self.hits += 1
+            return entry[1]
+        with self.lock:
+            self.misses += 1
+        if entry is not None:
+            self.delete(path, key)
+
+    def set(self, path, key, created, value):
+
+        nbytes = int(value.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self._pop((path, key))
+            if nbytes > self.max_bytes:
+                return
+            self.entries[(path, key)] = (created, value, nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def delete(self, path, key):
+
+        with self.lock:
+            self._pop((path, key))
+
+    def _pop(self, key):
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def pop_accessed(self, path=None):
+        """Retrieve and forget times of access that have not been
+        saved to disk yet.
+
+        :param str path: path of database (None: all databases)
+
+        :return: {path: [(time, key), ...]}
+        :rtype: dict
+        """
+        accessed = dict()
+        with self.lock:
+            for (p, key) in list(self.accessed):
+                if path is None or p == path:
+                    accessed.setdefault(p, list()).append(
+                        (self.accessed.pop((p, key)), key)
+                    )
+        return accessed
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        :return: hits, misses, evictions, number of entries and bytes
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.nbytes
+            }
+
+
+MEMORY_CACHE = MemoryCache()
+
+
+@contextmanager
+def _connect(db_path):
+    """connection in autocommit mode, closed on exit
+
+    """
+    con = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    try:
+        con.execute("PRAGMA synchronous=NORMAL")
+        yield con
+    finally:
+        con.close()
+
+
+def _save_accessed(con, accessed):
+    """save times of access of memory hits (never turning back time)
+
+    """
+    con.executemany(
+        "UPDATE cache SET accessed = MAX(accessed, ?) WHERE key = ?", accessed
+    )
+
+
+def flush():
+    """Save times of access of memory hits of all caches to disk."""
+    for db_path, accessed in MEMORY_CACHE.pop_accessed().items():
+        try:
+            with _connect(db_path) as con:
+                _save_accessed(con, accessed)
+        except sqlite3.DatabaseError as e:
+            logger.error(f'cannot write to cache: {e}')
+
+
+atexit.register(flush)
+
+
 class Cache:
-    
-    def __init__(self, path=None):
+    """Key-value store for pickled objects backed by SQLite.
+
+    The database is run in WAL mode, so several processes (and
+    threads) can read and write concurrently.  Each entry keeps its
+    size and time of creation and last access; if max_bytes is given,
+    least recently used entries are evicted once the entries exceed
+    this budget.  Entries that cannot be unpickled (or a database that
+    cannot be read) count as cache misses.
+
+    If pyarrow is installed, DataFrames are not pickled but saved as
+    Arrow IPC files next to the database; these are read via memory
+    mapping, and get_items only converts the requested rows.
+
+    DataFrames are additionally kept in MEMORY_CACHE, which is shared
+    by all caches of the process; callers get a copy unless they
+    promise not to modify the DataFrame (see get).  Memory hits only
+    check (read-only) that the entry on disk is unchanged; their times
+    of access are saved before least recently used entries are evicted
+    (and on exit).
+
+    """
+
+    def __init__(self, path=None, max_bytes=None):
 
         self.path = path
+        self.max_bytes = max_bytes
 
         if path:
             directory = os.path.dirname(path)
             os.makedirs(directory, exist_ok=True)
+            self.db_path = path + ".sqlite"
+            self.frame_dir = path + "_frames"
+            try:
+                with self._connect() as con:
+                    con.execute("PRAGMA journal_mode=WAL")
+                    con.execute(
+                        "CREATE TABLE IF NOT EXISTS cache ("
+                        "key TEXT PRIMARY KEY, value BLOB, frame TEXT, "
+                        "size INTEGER, created REAL, accessed REAL)"
+                    )
+                    con.execute(
+                        "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+                    )
+            except sqlite3.DatabaseError as e:
+                logger.error(f'cannot initialize cache: {e}')
+
+    @staticmethod
+    def _key(identifier):
+
+        if isinstance(identifier, str):
+            return identifier
+        return generate_idx(identifier)
+
+    def _connect(self):
+
+        return _connect(self.db_path)
+
+    def _remove_frames(self, frames):
+        """delete Arrow files of deleted entries
+
+        """
+        for frame in frames:
+            if frame is not None:
+                try:
+                    os.remove(os.path.join(self.frame_dir, frame))
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self, con):
+        """delete least recently used entries until size <= max_bytes
+
+        :return: Arrow files of evicted entries
+        :rtype: list
+        """
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        rows = con.execute("SELECT key, frame, size FROM cache ORDER BY accessed").fetchall()
+        evict = list()
+        frames = list()
+        for key, frame, size in rows:
+            if total <= self.max_bytes:
+                break
+            evict.append((key, ))
+            frames.append(frame)
+            total -= size
+        logger.info(f'evicting {len(evict)} objects from cache')
+        con.executemany("DELETE FROM cache WHERE key = ?", evict)
+        return frames
+
+    def _read(self, key, items=None, column='item'):
+        """retrieve entry (only rows with column in items for Arrow
+        files) and its creation time, (None, None) if missing or corrupt
+
+        """
+        try:
+            with self._connect() as con:
+                row = con.execute(
+                    "SELECT value, frame, created FROM cache WHERE key = ?", (key, )
+                ).fetchone()
+                if row is None:
+                    return None, None
+                value, frame, created = row
+                try:
+                    if frame is not None:
+                        value = self._read_frame(frame, items, column)
+                    else:
+                        value = pickle.loads(value)
+                        if items is not None:
+                            value = self._select(value, items, column)
+                except FileNotFoundError:
+                    # replaced by concurrent writer
+                    return None, None
+                except KeyError:
+                    # column not in DataFrame
+                    raise
+                except Exception:
+                    logger.warning(f'corrupt object "{key}" in cache, deleting')
+                    con.execute(
+                        "DELETE FROM cache WHERE key = ? AND frame IS ?", (key, frame)
+                    )
+                    self._remove_frames([frame])
+                    return None, None
+                con.execute(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", (time(), key)
+                )
+        except sqlite3.DatabaseError as e:
+            logger.error(f'cannot read cache: {e}')
+            return None, None
+
+        logger.info(f'retrieving object "{key}" from cache')
+        return value, created
+
+    def _valid(self, key):
+        """check that entry on disk has not changed since it was
+        created at given time
+
+        """
+        def valid(created):
+            try:
+                with self._connect() as con:
+                    row = con.execute(
+                        "SELECT created FROM cache WHERE key = ?", (key, )
+                    ).fetchone()
+            except sqlite3.DatabaseError as e:
+                logger.error(f'cannot read cache: {e}')
+                return False
+            return row is not None and row[0] == created
+        return valid
+
+    def _flush(self, con):
+
+        accessed = MEMORY_CACHE.pop_accessed(self.db_path).get(self.db_path)
+        if accessed:
+            _save_accessed(con, accessed)
+
+    def flush(self):
+        """Save times of access of memory hits to disk."""
+
+        if self.path is None:
+            return
+
+        try:
+            with self._connect() as con:
+                self._flush(con)
+        except sqlite3.DatabaseError as e:
+            logger.error(f'cannot write to cache: {e}')
+
+    def _read_frame(self, frame, items=None, column='item'):
+
+        with pa.memory_map(os.path.join(self.frame_dir, frame)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            if items is None:
+                return table.to_pandas()
+            try:
+                value_set = pa.array(list(items), table[column].type)
+            except pa.ArrowException:
+                # items of different type: select in pandas
+                df = table.to_pandas()
+                return self._select(df, items, column)
+            return table.filter(pc.is_in(table[column], value_set=value_set)).to_pandas()
+
+    @staticmethod
+    def _select(df, items, column):
+
+        if column in df.index.names:
+            values = df.index.get_level_values(column)
+        else:
+            values = df[column]
+        return df.loc[values.isin(items)]
+
+    def _write_frame(self, key, df):
+        """save DataFrame as Arrow IPC file (atomically)
+
+        :return: name of file, None if DataFrame cannot be converted
+        :rtype: str
+        """
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            logger.info(f'cannot convert object "{key}" to Arrow ({e}), pickling')
+            return
+
+        os.makedirs(self.frame_dir, exist_ok=True)
+        fd, tmp = mkstemp(dir=self.frame_dir, prefix=generate_idx([key]) + "-", suffix=".tmp")
+        frame = os.path.basename(tmp)[:-len(".tmp")] + ".arrow"
+        try:
+            with os.fdopen(fd, "wb") as f, pa.ipc.new_file(f, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp, os.path.join(self.frame_dir, frame))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        return frame
 
     def delete(self, identifier):
 
@@ -52,31 +429,70 @@ class Cache:
             logger.info('no cache path')
             return
 
-        if isinstance(identifier, str):
-            key = identifier
-        else:
-            key = generate_idx(identifier)
+        key = self._key(identifier)
 
-        with shelve.open(self.path) as shelf:
-            if key in shelf.keys():
+        with self._connect() as con:
+            row = con.execute("SELECT frame FROM cache WHERE key = ?", (key, )).fetchone()
+            if row is not None:
                 logger.info(f'deleting object "{key}" from cache')
-                del shelf[key]
+                con.execute("DELETE FROM cache WHERE key = ?", (key, ))
+                self._remove_frames(row)
+        MEMORY_CACHE.delete(self.db_path, key)
 
-    def get(self, identifier):
+    def get(self, identifier, copy=True):
+        """Retrieve object.
+
+        :param identifier: identifier of object
+        :param bool copy: copy DataFrames; set to False only if the
+                          DataFrame is not modified (it is shared)
+
+        :return: object, None if not in cache
+        """
 
         if self.path is None:
             logger.info('no cache path')
             return
 
-        if isinstance(identifier, str):
-            key = identifier
-        else:
-            key = generate_idx(identifier)
+        key = self._key(identifier)
+
+        value = MEMORY_CACHE.get(self.db_path, key, self._valid(key))
+        if value is not None:
+            logger.info(f'retrieving object "{key}" from memory')
+            return value.copy() if copy else value
+
+        value, created = self._read(key)
+        if isinstance(value, DataFrame):
+            MEMORY_CACHE.set(self.db_path, key, created, value)
+            return value.copy() if copy else value
+
+        return value
+
+    def get_items(self, identifier, items, column='item'):
+        """Retrieve rows of a cached DataFrame whose value in column
+        (index level or column) is in items.
+
+        :param identifier: identifier of DataFrame
+        :param list items: values to select
+        :param str column: name of index level / column to look up
 
-        with shelve.open(self.path) as shelf:
-            if key in shelf.keys():
-                logger.info(f'retrieving object "{key}" from cache')
-                return shelf[key]
+        :return: selected rows, None if not in cache
+        :rtype: DataFrame
+
+        """
+
+        if self.path is None:
+            logger.info('no cache path')
+            return
+
+        key = self._key(identifier)
+
+        value = MEMORY_CACHE.get(self.db_path, key, self._valid(key))
+        if value is not None:
+            logger.info(f'retrieving object "{key}" from memory')
+            # selection is a copy
+            return self._select(value, items, column)
+
+        return self._read(key, items, column)[0]
 
     def set(self, identifier, value):
 
@@ -84,11 +500,42 @@ class Cache:
             logger.info('no cache path')
             return
 
-        if isinstance(identifier, str):
-            key = identifier
+        key = self._key(identifier)
+
+        frame = None
+        blob = None
+        if pa is not None and isinstance(value, DataFrame):
+            frame = self._write_frame(key, value)
+        if frame is None:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            size = len(blob)
         else:
-            key = generate_idx(identifier)
+            size = os.path.getsize(os.path.join(self.frame_dir, frame))
+
+        MEMORY_CACHE.delete(self.db_path, key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            logger.warning(f'object "{key}" exceeds cache size, not saving')
+            self._remove_frames([frame])
+            return
 
-        with shelve.open(self.path) as shelf:
-            logger.info(f'saving object "{key}" to cache')
-            shelf[key] = value
+        try:
+            with self._connect() as con:
+                logger.info(f'saving object "{key}" to cache')
+                now = time()
+                con.execute("BEGIN IMMEDIATE")
+                self._flush(con)
+                replaced = con.execute(
+                    "SELECT frame FROM cache WHERE key = ?", (key, )
+                ).fetchone() or []
+                con.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, blob, frame, size, now, now)
+                )
+                evicted = self._evict(con) if self.max_bytes is not None else []
+                con.execute("COMMIT")
+            self._remove_frames(list(replaced) + evicted)
+            if isinstance(value, DataFrame):
+                MEMORY_CACHE.set(self.db_path, key, now, value.copy())
+        except sqlite3.DatabaseError as e:
+            logger.error(f'cannot write to cache: {e}')
+            self._remove_frames([frame])
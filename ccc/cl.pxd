@@ -6,8 +6,8 @@
 
 
 cdef extern from "stdlib.h":
-    void * malloc(int size)
-    void free(void*)
+    void * malloc(int size) nogil
+    void free(void*) nogil
 
 
 cdef extern from "string.h":
@@ -38,30 +38,30 @@ cdef extern from "cwb/cl.h":
     CorpusCharset cl_corpus_charset(c_Corpus * corpus)
     char * cl_charset_name(CorpusCharset id)
     void cl_delete_corpus(c_Corpus * corpus)
-    char * cl_cpos2str(c_Attribute * attribute, int position)
-    int cl_cpos2id(c_Attribute * attribute, int position)
-    char * cl_struc2str(c_Attribute * attribute, int position)
-    bint cl_struc2cpos(c_Attribute * attribute, int position, int * start, int * end)
-    int cl_str2id(c_Attribute * attribute, char * str)
-    char * cl_id2str(c_Attribute * attribute, int id)
-    int cl_cpos2struc(c_Attribute * attribute, int offset)
-    int cl_max_struc(c_Attribute * attribute)
-    int cl_max_id(c_Attribute * attribute)
-    int cl_max_cpos(c_Attribute * attribute)
+    char * cl_cpos2str(c_Attribute * attribute, int position) nogil
+    int cl_cpos2id(c_Attribute * attribute, int position) nogil
+    char * cl_struc2str(c_Attribute * attribute, int position) nogil
+    bint cl_struc2cpos(c_Attribute * attribute, int position, int * start, int * end) nogil
+    int cl_str2id(c_Attribute * attribute, char * str) nogil
+    char * cl_id2str(c_Attribute * attribute, int id) nogil
+    int cl_cpos2struc(c_Attribute * attribute, int offset) nogil
+    int cl_max_struc(c_Attribute * attribute) nogil
+    int cl_max_id(c_Attribute * attribute) nogil
+    int cl_max_cpos(c_Attribute * attribute) nogil
     bint cl_struc_values(c_Attribute * attribute)
-    int * cl_id2cpos(c_Attribute * attribute, int tagid, int * result_len)
-    int cl_id2freq(c_Attribute * attribute, int tagid)
-    int cl_max_alg(c_Attribute * attribute)
-    int cl_cpos2alg(c_Attribute * attribute, int cpos)
-    int cl_alg2cpos(c_Attribute * attribute, int alg, int * source_start, int * source_end, int * target_start, int * target_end)
-    int * collect_matching_ids(c_Attribute * attribute, char * pattern, int canonicalize, int * number_of_matches)
-    int * cl_idlist2cpos(c_Attribute * attribute, int * ids, int number_of_ids, int sort, int * size_of_table)
+    int * cl_id2cpos(c_Attribute * attribute, int tagid, int * result_len) nogil
+    int cl_id2freq(c_Attribute * attribute, int tagid) nogil
+    int cl_max_alg(c_Attribute * attribute) nogil
+    int cl_cpos2alg(c_Attribute * attribute, int cpos) nogil
+    int cl_alg2cpos(c_Attribute * attribute, int alg, int * source_start, int * source_end, int * target_start, int * target_end) nogil
+    int * collect_matching_ids(c_Attribute * attribute, char * pattern, int canonicalize, int * number_of_matches) nogil
+    int * cl_idlist2cpos(c_Attribute * attribute, int * ids, int number_of_ids, int sort, int * size_of_table) nogil
     int get_struc_attribute(c_Attribute * attribute, int cpos, int * s_start, int * s_end)
     int get_num_of_struc(c_Attribute * attribute, int cpos, int * s_num)
     int get_bounds_of_nth_struc(c_Attribute * attribute, int struc_num, int * s_start, int * s_end)
 
 
-cdef class Corpus:
+cdef class CorpusData:
     cdef c_Corpus * corpus
     cdef object name
     cdef object charset_decoder
@@ -70,28 +70,44 @@ cdef class Corpus:
     cpdef unicode to_unicode(self, s)
 
 
+cdef class Corpus:
+    cdef CorpusData data
+    cdef dict handles
+    cpdef bytes to_str(self, s)
+    cpdef unicode to_unicode(self, s)
+
+
 cdef class IDList:
     cdef int * ids
     cdef int length
+    cdef object base
+    cdef Py_ssize_t shape
+    cdef Py_ssize_t stride
     cpdef IDList join(self, IDList other, int offset)
 
 
 cdef class PosAttrib:
     cdef c_Attribute * att
-    cdef Corpus parent
+    cdef CorpusData parent
     cdef object attname
+    cdef object lexicon
+    cdef int max_cpos
+    cdef int max_id
+    cdef object lock
     cpdef cpos2id(self, int offset)
 
 
 cdef class AttStruc:
     cdef c_Attribute * att
-    cdef bint has_values
-    cdef Corpus parent
+    cdef readonly bint has_values
+    cdef int max_struc
+    cdef CorpusData parent
     cdef object attname
+    cdef object index
 
 
 cdef class AlignAttrib:
     cdef c_Attribute * att
     cdef bint has_values
-    cdef Corpus parent
+    cdef CorpusData parent
     cdef object attname
@@ -6,19 +6,58 @@ cl.pyx: low-level access to cwb.cl
 
 Original version by Yannick Versley (2013)
 Current version by Philipp Heinrich (2021)
+
+Thread safety: the loops over corpus positions, lexicon IDs, and
+regions (IDList set operations, cpos2ids, find_list, find_pattern,
+map_idlist, slicing, ...) release the GIL, so they can run in parallel
+threads.  Decoding the token stream of a p-attribute (cl_cpos2id,
+cl_cpos2str) is not thread-safe, since the CL keeps the last
+decompressed block of Huffman-coded attributes in the attribute; all
+PosAttrib methods that decode positions thus hold a lock of the
+attribute, i.e. they run in parallel only for different attributes.
+The CL hands out the same attribute to all Corpus objects of a corpus
+(including copies), so the locks are kept per CL attribute, not per
+handle.
+Other reads (cl_id2str, cl_id2cpos, cl_struc2cpos, ...) are safe once
+the attribute's components are loaded; components are however loaded
+lazily and without locking on first access, so each attribute should
+be accessed once (e.g. via len()) before it is shared between threads.
+Error codes (cl_errno) are global and may be overwritten by concurrent
+calls.  Creating corpora and attributes is not thread-safe;
+Corpus.attribute() hands out one shared handle per attribute.
 """
 
 import codecs
+import threading
+
+import numpy as np
 
+cimport cython
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_STRIDES, PyBUF_WRITABLE
 from cpython.version cimport PY_MAJOR_VERSION
 
+# locks of CL p-attributes, keyed by address of the attribute
+_attribute_locks = dict()
+_attribute_locks_lock = threading.Lock()
+
+
+def _attribute_lock(size_t address):
+    with _attribute_locks_lock:
+        lock = _attribute_locks.get(address)
+        if lock is None:
+            lock = _attribute_locks[address] = threading.Lock()
+        return lock
+
+
 encoding_names = {
     'utf8': 'UTF-8',
     'latin1': 'ISO-8859-15'
 }
 
 
-cdef class Corpus:
+cdef class CorpusData:
+    """owner of the CL corpus and its codecs; shared by the Corpus and
+    its attribute handles (which thus do not refer back to the Corpus)"""
 
     def __cinit__(self, cname, encoding=None,
                   registry_dir="/usr/local/share/cwb/registry/"):
@@ -74,13 +113,43 @@ cdef class Corpus:
             cl_delete_corpus(self.corpus)
             self.corpus = NULL
 
+
+cdef class Corpus:
+
+    def __cinit__(self, cname, encoding=None,
+                  registry_dir="/usr/local/share/cwb/registry/"):
+        self.data = CorpusData(cname, encoding, registry_dir)
+        self.handles = dict()
+
+    cpdef bytes to_str(self, s):
+        return self.data.to_str(s)
+
+    cpdef unicode to_unicode(self, s):
+        return self.data.to_unicode(s)
+
+    def get_encoding(self):
+        return self.data.get_encoding()
+
+    def __repr__(self):
+        return repr(self.data)
+
     def attribute(self, name, atype):
+        """returns the handle of the attribute; handles are created once
+        per corpus and shared, together with their lazily loaded data
+        (sizes, decoded lexicon, value index)"""
+        key = (name, atype)
+        if key in self.handles:
+            return self.handles[key]
         if atype == 's':
-            return AttStruc(self, name)
+            att = AttStruc(self, name)
         elif atype == 'p':
-            return PosAttrib(self, name)
+            att = PosAttrib(self, name)
         elif atype == 'a':
-            return AlignAttrib(self, name)
+            att = AlignAttrib(self, name)
+        else:
+            return None
+        self.handles[key] = att
+        return att
 
 
 cdef class IDList:
@@ -103,6 +172,55 @@ cdef class IDList:
                 self.ids[i] = seq[i]
             assert sorted
 
+    @staticmethod
+    def from_array(arr):
+        """wraps a sorted array of corpus positions; C-contiguous int32
+        arrays are used without copying, other arrays are converted"""
+        cdef const int[::1] view = np.ascontiguousarray(arr, dtype=np.int32)
+        cdef IDList lst = IDList()
+        values = np.asarray(view)
+        if len(values) > 1 and (values[1:] < values[:-1]).any():
+            raise ValueError('IDList must be sorted')
+        lst.base = view
+        lst.length = view.shape[0]
+        if lst.length > 0:
+            lst.ids = <int*> &view[0]
+        return lst
+
+    def __getbuffer__(self, Py_buffer * buffer, int flags):
+        # read-only, one-dimensional view on the positions
+        if flags & PyBUF_WRITABLE:
+            raise BufferError('IDList is read-only')
+        self.shape = self.length
+        self.stride = sizeof(int)
+        buffer.buf = <void*> self.ids
+        buffer.obj = self
+        buffer.len = self.length * sizeof(int)
+        buffer.readonly = 1
+        buffer.itemsize = sizeof(int)
+        buffer.format = NULL
+        if flags & PyBUF_FORMAT:
+            buffer.format = 'i'
+        buffer.ndim = 1
+        buffer.shape = &self.shape
+        buffer.strides = NULL
+        if flags & PyBUF_STRIDES:
+            buffer.strides = &self.stride
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+
+    def __releasebuffer__(self, Py_buffer * buffer):
+        pass
+
+    property __array_interface__:
+        def __get__(self):
+            return {
+                'shape': (self.length, ),
+                'typestr': np.dtype(np.intc).str,
+                'data': (<size_t> self.ids, True),
+                'version': 3
+            }
+
     def __len__(self):
         return self.length
 
@@ -129,74 +247,78 @@ cdef class IDList:
         else:
             return False
 
-    def __and__(IDList self, IDList other):
-        return self.join(other, 0)
+    def __and__(IDList self, other):
+        return self.join(as_idlist(other), 0)
 
-    def __or__(IDList self, IDList other):
+    def __or__(IDList self, other_):
+        cdef IDList other = as_idlist(other_)
         cdef int * result
         cdef int k1, k2, k
         cdef int val1, val2
         cdef IDList r
         # allocate once, using a conservative estimate on
         # how big the result list is
-        result = <int*> malloc((self.length+other.length)*sizeof(int))
-        k1 = k2 = k = 0
-        while k1 < self.length and k2 < other.length:
-            val1 = self.ids[k1]
-            val2 = other.ids[k2]
-            if val1 < val2:
+        with nogil:
+            result = <int*> malloc((self.length+other.length)*sizeof(int))
+            k1 = k2 = k = 0
+            while k1 < self.length and k2 < other.length:
+                val1 = self.ids[k1]
+                val2 = other.ids[k2]
+                if val1 < val2:
+                    result[k] = val1
+                    k += 1
+                    k1 += 1
+                elif val2 < val1:
+                    result[k] = val2
+                    k += 1
+                    k2 += 1
+                else:
+                    result[k] = val1
+                    k += 1
+                    k1 += 1
+                    k2 += 1
+            while k1 < self.length:
+                val1 = self.ids[k1]
                 result[k] = val1
                 k += 1
                 k1 += 1
-            elif val2 < val1:
+            while k2 < other.length:
+                val2 = other.ids[k2]
                 result[k] = val2
                 k += 1
                 k2 += 1
-            else:
-                result[k] = val1
-                k += 1
-                k1 += 1
-                k2 += 1
-        while k1 < self.length:
-            val1 = self.ids[k1]
-            result[k] = val1
-            k += 1
-            k1 += 1
-        while k2 < other.length:
-            val2 = other.ids[k2]
-            result[k] = val2
-            k += 1
-            k2 += 1
         r = IDList()
         r.length = k
         r.ids = result
         return r
 
-    def __sub__(IDList self, IDList other):
+    def __sub__(IDList self, other_):
+        cdef IDList other = as_idlist(other_)
         cdef int * result
         cdef int k1, k2, k
         cdef int val1, val2
         cdef IDList r
         # allocate once, using a conservative estimate on
         # how big the result list is
-        result = <int*> malloc(self.length*sizeof(int))
-        k1 = k2 = k = 0
-        while k1 < self.length and k2 < other.length:
-            val1 = self.ids[k1]
-            val2 = other.ids[k2]
-            if val1 < val2:
-                result[k] = val1
+        with nogil:
+            result = <int*> malloc(self.length*sizeof(int))
+            k1 = k2 = k = 0
+            while k1 < self.length and k2 < other.length:
+                val1 = self.ids[k1]
+                val2 = other.ids[k2]
+                if val1 < val2:
+                    result[k] = val1
+                    k += 1
+                    k1 += 1
+                elif val2 < val1:
+                    k2 += 1
+                else:
+                    k1 += 1
+                    k2 += 1
+            while k1 < self.length:
+                result[k] = self.ids[k1]
                 k += 1
                 k1 += 1
-            elif val2 < val1:
-                k2 += 1
-            else:
-                k1 += 1
-                k2 += 1
-        while k1 < self.length:
-            result[k] = self.ids[k1]
-            k += 1
-            k1 += 1
         r = IDList()
         r.length = k
         r.ids = result
@@ -209,39 +331,48 @@ cdef class IDList:
         cdef IDList r
         # allocate once, using a conservative estimate on
         # how big the result list is
-        if other.length < self.length:
-            result = <int*> malloc(other.length*sizeof(int))
-        else:
-            result = <int*> malloc(self.length*sizeof(int))
-        k1 = k2 = k = 0
-        while k1 < self.length and k2 < other.length:
-            val1 = self.ids[k1]
-            val2 = other.ids[k2]-offset
-            if val1 < val2:
-                k1 += 1
-            elif val2 < val1:
-                k2 += 1
+        with nogil:
+            if other.length < self.length:
+                result = <int*> malloc(other.length*sizeof(int))
             else:
-                result[k] = val1
-                k += 1
-                k1 += 1
-                k2 += 1
+                result = <int*> malloc(self.length*sizeof(int))
+            k1 = k2 = k = 0
+            while k1 < self.length and k2 < other.length:
+                val1 = self.ids[k1]
+                val2 = other.ids[k2]-offset
+                if val1 < val2:
+                    k1 += 1
+                elif val2 < val1:
+                    k2 += 1
+                else:
+                    result[k] = val1
+                    k += 1
+                    k1 += 1
+                    k2 += 1
         r = IDList()
         r.length = k
         r.ids = result
         return r
 
     def __dealloc__(self):
-        if self.ids != NULL:
+        # memory of wrapped arrays is owned by self.base
+        if self.ids != NULL and self.base is None:
             free(self.ids)
 
 
+cdef IDList as_idlist(obj):
+    if isinstance(obj, IDList):
+        return obj
+    return IDList.from_array(obj)
+
+
 cdef class PosAttrib:
 
     def __repr__(self):
         return "CWB.Attribute(%s,'%s')" % (self.parent, self.attname)
 
-    def __cinit__(self, Corpus parent, attname):
+    def __cinit__(self, Corpus corpus, attname):
+        cdef CorpusData parent = corpus.data
         self.parent = parent
         self.attname = attname
         if isinstance(attname, unicode):
@@ -249,6 +380,9 @@ cdef class PosAttrib:
         self.att = cl_new_attribute(parent.corpus, attname, ATT_POS)
         if self.att == NULL:
             raise KeyError
+        self.max_cpos = -1
+        self.max_id = -1
+        self.lock = _attribute_lock(<size_t> self.att)
 
     def getName(self):
         return self.attname
@@ -256,13 +390,29 @@ cdef class PosAttrib:
     def getDictionary(self):
         return AttrDictionary(self)
 
+    property size:
+        """number of corpus positions"""
+        def __get__(self):
+            if self.max_cpos < 0:
+                self.max_cpos = cl_max_cpos(self.att)
+            return self.max_cpos
+
+    property lexicon_size:
+        """number of types in the lexicon"""
+        def __get__(self):
+            if self.max_id < 0:
+                self.max_id = cl_max_id(self.att)
+            return self.max_id
+
     def __getitem__(self, offset):
-        cdef int i
+        cdef int i, start, stop
+        cdef char ** strs
         cdef bytes _result
         if isinstance(offset, int):
             if offset < 0 or offset >= len(self):
                 raise IndexError('P-attribute offset out of bounds')
-            _result = cl_cpos2str(self.att, offset)
+            with self.lock:
+                _result = cl_cpos2str(self.att, offset)
             if PY_MAJOR_VERSION >= 3:
                 return self.parent.to_unicode(_result)
             else:
@@ -271,17 +421,65 @@ cdef class PosAttrib:
             result = []
             if offset.start < 0 or offset.stop < offset.start or offset.stop > len(self):
                 raise IndexError('P-attribute offset out of bounds')
-            if PY_MAJOR_VERSION >= 3:
-                for i from offset.start <= i < offset.stop:
-                    _result = cl_cpos2str(self.att, i)
-                    result.append(self.parent.to_unicode(_result))
-            else:
-                for i from offset.start <= i < offset.stop:
-                    result.append(cl_cpos2str(self.att, i))
+            start = offset.start
+            stop = offset.stop
+            # look up all strings first, then convert them
+            strs = <char**> malloc((stop - start)*sizeof(char*))
+            with self.lock:
+                with nogil:
+                    for i from start <= i < stop:
+                        strs[i - start] = cl_cpos2str(self.att, i)
+            try:
+                for i from 0 <= i < stop - start:
+                    _result = strs[i]
+                    if PY_MAJOR_VERSION >= 3:
+                        result.append(self.parent.to_unicode(_result))
+                    else:
+                        result.append(_result)
+            finally:
+                free(strs)
         return result
 
     cpdef cpos2id(self, int offset):
-        return cl_cpos2id(self.att, offset)
+        with self.lock:
+            return cl_cpos2id(self.att, offset)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def cpos2ids(self, cpos):
+        """returns an int32 array with the lexicon IDs of the given corpus
+        positions (array-like); positions outside the corpus (e.g. -1)
+        are mapped to -1"""
+        cdef const int[::1] cpos_view = np.ascontiguousarray(cpos, dtype=np.int32)
+        cdef Py_ssize_t i, n = cpos_view.shape[0]
+        cdef int c, max_cpos = cl_max_cpos(self.att)
+        result = np.empty(n, dtype=np.int32)
+        cdef int[::1] result_view = result
+        with self.lock:
+            with nogil:
+                for i from 0 <= i < n:
+                    c = cpos_view[i]
+                    if c < 0 or c >= max_cpos:
+                        result_view[i] = -1
+                    else:
+                        result_view[i] = cl_cpos2id(self.att, c)
+        return result
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def range2ids(self, int start, int stop):
+        """returns an int32 array with the lexicon IDs of the corpus
+        positions start .. stop - 1 (like slicing)"""
+        cdef int i
+        if start < 0 or stop < start or stop > cl_max_cpos(self.att):
+            raise IndexError('P-attribute offset out of bounds')
+        result = np.empty(stop - start, dtype=np.int32)
+        cdef int[::1] result_view = result
+        with self.lock:
+            with nogil:
+                for i from start <= i < stop:
+                    result_view[i - start] = cl_cpos2id(self.att, i)
+        return result
 
     def find(self, tag):
         cdef int tagid
@@ -291,7 +489,8 @@ cdef class PosAttrib:
         if tagid < 0:
             raise KeyError
         lst = IDList()
-        lst.ids = cl_id2cpos(self.att, tagid, & lst.length)
+        with nogil:
+            lst.ids = cl_id2cpos(self.att, tagid, & lst.length)
         return lst
 
     def find_list(self, tags):
@@ -307,16 +506,20 @@ cdef class PosAttrib:
             ids_set.add(tagid)
         lst = IDList(sorted(ids_set))
         lst_result = IDList()
-        lst_result.ids = cl_idlist2cpos(self.att, lst.ids, lst.length, 1, & lst_result.length)
+        with nogil:
+            lst_result.ids = cl_idlist2cpos(self.att, lst.ids, lst.length, 1, & lst_result.length)
         return lst_result
 
     def find_pattern(self, pat, flags=0):
         cdef IDList lst, lst_result
         cdef bytes pat_s = self.parent.to_str(pat)
+        cdef char * pattern = pat_s
+        cdef int canonicalize = flags
         lst = IDList()
-        lst.ids = collect_matching_ids(self.att, pat_s, flags, & lst.length)
         lst_result = IDList()
-        lst_result.ids = cl_idlist2cpos(self.att, lst.ids, lst.length, 1, & lst_result.length)
+        with nogil:
+            lst.ids = collect_matching_ids(self.att, pattern, canonicalize, & lst.length)
+            lst_result.ids = cl_idlist2cpos(self.att, lst.ids, lst.length, 1, & lst_result.length)
         return lst_result
 
     def frequency(self, tag):
@@ -327,7 +530,7 @@ cdef class PosAttrib:
         return cl_id2freq(self.att, tagid)
 
     def __len__(self):
-        return cl_max_cpos(self.att)
+        return self.size
 
 
 cdef class AttrDictionary:
@@ -337,7 +540,7 @@ cdef class AttrDictionary:
         self.attr = d
 
     def __len__(self):
-        return cl_max_id(self.attr.att)
+        return self.attr.lexicon_size
 
     def __getitem__(self, s):
         cdef int val
@@ -367,13 +570,36 @@ cdef class AttrDictionary:
             result.append(cl_id2str(self.attr.att, lst.ids[i]))
         return result
 
+    def ids2str(self, ids):
+        """decodes an array of lexicon IDs to an object array of strings
+        (None for negative IDs).  decoded types are memoised on the
+        attribute, so each type is decoded only once"""
+        cdef char * s
+        cdef int i
+        if self.attr.lexicon is None:
+            self.attr.lexicon = np.empty(cl_max_id(self.attr.att), dtype=object)
+        lexicon = self.attr.lexicon
+        ids = np.asarray(ids, dtype=np.int32)
+        valid = ids >= 0
+        types = np.unique(ids[valid])
+        if len(types) > 0 and types[-1] >= len(lexicon):
+            raise IndexError('lexicon ID out of bounds')
+        for i in types:
+            if lexicon[i] is None:
+                s = cl_id2str(self.attr.att, i)
+                lexicon[i] = self.attr.parent.to_unicode(s)
+        result = np.empty(len(ids), dtype=object)
+        result[valid] = lexicon[ids[valid]]
+        return result
+
 
 cdef class AttStruc:
 
     def __repr__(self):
         return "CWB.CL.AttrStruct(%s,'%s')" % (self.parent, self.attname)
 
-    def __cinit__(self, Corpus parent, attname):
+    def __cinit__(self, Corpus corpus, attname):
+        cdef CorpusData parent = corpus.data
         self.parent = parent
         self.attname = attname
         if isinstance(attname, unicode):
@@ -382,22 +608,50 @@ cdef class AttStruc:
         if self.att == NULL:
             raise KeyError
         self.has_values = cl_struc_values(self.att)
+        self.max_struc = -1
 
     def getName(self):
         return self.attname
 
+    property size:
+        """number of regions"""
+        def __get__(self):
+            if self.max_struc < 0:
+                self.max_struc = cl_max_struc(self.att)
+            return self.max_struc
+
     def find_all(self, tags):
-        # s-attr string attributes are not indexed
-        # so we just do the stupid thing here.
+        # s-attr string attributes are not indexed by the CWB,
+        # so we build an inverted index on first use.
         cdef int i
-        strucs = []
+        if self.index is None:
+            values, offsets, strucs = self.value_index()
+            self.index = (dict(zip(values, range(len(values)))), offsets, strucs)
+        positions, offsets, strucs = self.index
+        result = []
+        for tag in set(tags):
+            if tag in positions:
+                i = positions[tag]
+                result.extend(strucs[offsets[i]:offsets[i + 1]].tolist())
+        return sorted(result)
+
+    def value_index(self):
+        """inverted index of the values: returns the distinct (undecoded)
+        values in sorted order, int64 offsets and int32 strucs such that
+        strucs[offsets[i]:offsets[i+1]] are the regions annotated with
+        values[i] (in ascending order)"""
         if not self.has_values:
             raise TypeError
-        for i from 0 <= i < cl_max_struc(self.att):
-            struc_id = cl_struc2str(self.att, i)
-            if struc_id in tags:
-                strucs.append(i)
-        return strucs
+        start, end, codes, values = self.regions()
+        order = np.argsort(np.array(values, dtype=object), kind='stable')
+        rank = np.empty(len(values), dtype=np.int64)
+        rank[order] = np.arange(len(values))
+        valid = np.flatnonzero(codes >= 0)
+        keys = rank[codes[valid]]
+        strucs = valid[np.argsort(keys, kind='stable')].astype(np.int32)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=len(values)), out=offsets[1:])
+        return [values[i] for i in order], offsets, strucs
 
     def find_pos(self, offset):
         return self[cl_cpos2struc(self.att, offset)]
@@ -409,23 +663,114 @@ cdef class AttStruc:
             raise KeyError("no structure at this position")
         return val
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def cpos2strucs(self, cpos):
+        """vectorized cpos2struc: returns an int32 array of struc IDs,
+        -1 for positions that are not covered by any region"""
+        cdef const int[::1] cpos_view = np.ascontiguousarray(cpos, dtype=np.int32)
+        cdef Py_ssize_t i, n = cpos_view.shape[0]
+        cdef int val
+        result = np.empty(n, dtype=np.int32)
+        cdef int[::1] result_view = result
+        with nogil:
+            for i from 0 <= i < n:
+                val = cl_cpos2struc(self.att, cpos_view[i])
+                result_view[i] = val if val >= 0 else -1
+        return result
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def strucs2cpos(self, strucs):
+        """returns start and end of the given strucs as int32 arrays, -1
+        for invalid strucs (e.g. -1)"""
+        cdef const int[::1] struc_view = np.ascontiguousarray(strucs, dtype=np.int32)
+        cdef Py_ssize_t i, n = struc_view.shape[0]
+        cdef int struc, max_struc = cl_max_struc(self.att)
+        start = np.empty(n, dtype=np.int32)
+        end = np.empty(n, dtype=np.int32)
+        cdef int[::1] start_view = start
+        cdef int[::1] end_view = end
+        with nogil:
+            for i from 0 <= i < n:
+                struc = struc_view[i]
+                if struc < 0 or struc >= max_struc:
+                    start_view[i] = -1
+                    end_view[i] = -1
+                else:
+                    cl_struc2cpos(self.att, struc, & start_view[i], & end_view[i])
+        return start, end
+
     def map_idlist(self, IDList lst not None):
         """returns an IDList with (unique) struc offsets instead of
         corpus positions"""
         cdef IDList result = IDList()
         cdef int i, k, val, lastval
-        result.ids = <int*> malloc(lst.length*sizeof(int))
-        k = 0
-        lastval = -1
-        for i from 0 <= i < lst.length:
-            val = cl_cpos2struc(self.att, lst.ids[i])
-            if val >= 0 and val != lastval:
-                result.ids[k] = val
-                k += 1
-                lastval = val
+        with nogil:
+            result.ids = <int*> malloc(lst.length*sizeof(int))
+            k = 0
+            lastval = -1
+            for i from 0 <= i < lst.length:
+                val = cl_cpos2struc(self.att, lst.ids[i])
+                if val >= 0 and val != lastval:
+                    result.ids[k] = val
+                    k += 1
+                    lastval = val
         result.length = k
         return result
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def regions(self):
+        """returns start and end of all regions as int32 arrays, together
+        with the value codes and the distinct values as returned by
+        strucs2str (both None if the s-attribute has no values)"""
+        cdef int i, n = cl_max_struc(self.att)
+        start = np.empty(n, dtype=np.int32)
+        end = np.empty(n, dtype=np.int32)
+        cdef int[::1] start_view = start
+        cdef int[::1] end_view = end
+        with nogil:
+            for i from 0 <= i < n:
+                cl_struc2cpos(self.att, i, & start_view[i], & end_view[i])
+        if not self.has_values:
+            return start, end, None, None
+        codes, values = self.strucs2str(np.arange(n, dtype=np.int32))
+        return start, end, codes, values
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def strucs2str(self, strucs):
+        """returns the values of the given strucs as int32 codes into a list
+        of distinct (undecoded) values; each value is retrieved only
+        once. invalid strucs (e.g. -1) get code -1"""
+        cdef const int[::1] struc_view = np.ascontiguousarray(strucs, dtype=np.int32)
+        cdef Py_ssize_t i, n = struc_view.shape[0]
+        cdef int struc, max_struc = cl_max_struc(self.att)
+        if not self.has_values:
+            raise TypeError
+        # the address of a value in the string pool identifies the value
+        pointers = np.empty(n, dtype=np.intp)
+        cdef Py_ssize_t[::1] pointer_view = pointers
+        with nogil:
+            for i from 0 <= i < n:
+                struc = struc_view[i]
+                if struc < 0 or struc >= max_struc:
+                    pointer_view[i] = 0
+                else:
+                    pointer_view[i] = <Py_ssize_t> cl_struc2str(self.att, struc)
+        addresses, inverse = np.unique(pointers, return_inverse=True)
+        # retrieve each distinct value once
+        values = dict()
+        remap = np.empty(len(addresses), dtype=np.int32)
+        for i from 0 <= i < len(addresses):
+            if addresses[i] == 0:
+                remap[i] = -1
+            else:
+                value = <bytes> (<char *> <Py_ssize_t> addresses[i])
+                remap[i] = values.setdefault(value, len(values))
+        return remap[inverse], list(values)
+
     def __getitem__(self, index):
         cdef int start, end
         if index < 0 or index >= cl_max_struc(self.att):
@@ -437,7 +782,7 @@ cdef class AttStruc:
             return (start, end)
 
     def __len__(self):
-        return cl_max_struc(self.att)
+        return self.size
 
 
 cdef class AlignAttrib:
@@ -445,7 +790,8 @@ cdef class AlignAttrib:
     def __repr__(self):
         return "CWB.CL.AlignAttrib(%s, '%s')" % (self.parent, self.attname)
 
-    def __cinit__(self, Corpus parent, attname):
+    def __cinit__(self, Corpus corpus, attname):
+        cdef CorpusData parent = corpus.data
         self.parent = parent
         self.attname = attname
         if isinstance(attname, unicode):
@@ -6,14 +6,13 @@ definition of dump2cooc() and the Collocates class.
 
 """
 import logging
-from itertools import chain
 
 # requirements
-from pandas import DataFrame
+import numpy as np
+from pandas import DataFrame, concat
 
 # part of module
-from .counts import score_counts
-from .utils import node2cotext
+from .counts import decode_types, ids2types, score_counts
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +30,7 @@ class Collocates:
             return
 
         # init corpus
-        self.corpus = corpus.copy()
+        self.corpus = corpus
 
         # # what's in the dump?
         # self.df_dump = df_dump
@@ -79,6 +78,49 @@ class Collocates:
 
         return f
 
+    def count_windows(self, windows):
+        """Count collocates in several windows at once.  The lexicon IDs of
+        all co-occurring positions are retrieved once; positions are
+        counted per type and absolute offset, and the cumulative sums
+        yield the counts of all windows.
+
+        :param list windows: windows around the nodes
+
+        :return: frequency table per window
+        :rtype: dict
+
+        """
+
+        # check windows
+        if self.mws is not None and max(windows) > self.mws:
+            logger.warning('requested window outside maximum window size')
+        width = max(min(window, self.mws) if self.mws is not None else window for window in windows) + 1
+
+        # lexicon IDs of relevant positions
+        atts = [self.corpus.attributes.attribute(p_att, 'p') for p_att in self.p_query]
+        abs_offset = np.abs(self.df_cooc['offset'].values.astype(np.int64))
+        relevant = abs_offset < width
+        cpos = self.df_cooc['cpos'].values.astype(np.int64)[relevant]
+        abs_offset = abs_offset[relevant]
+        ids = [att.cpos2ids(cpos) for att in atts]
+
+        # counts per type and absolute offset
+        logger.info(f'counting {len(cpos)} positions in windows up to {width - 1}')
+        types, inverse = ids2types(atts, ids)
+        counts = np.bincount(
+            inverse * width + abs_offset, minlength=len(types[0]) * width
+        ).reshape(-1, width).cumsum(axis=1)
+
+        output = dict()
+        for window in windows:
+            freqs = counts[:, min(window, width - 1)]
+            nonzero = freqs > 0
+            output[window] = decode_types(
+                atts, self.p_query, [t[nonzero] for t in types], freqs[nonzero]
+            )
+
+        return output
+
     def show(self, window=5, order='log_likelihood', cut_off=100,
              ams=None, min_freq=2, frequencies=True, flags=None,
              marginals='corpus', show_negative=False):
@@ -88,17 +130,71 @@ class Collocates:
             logger.error("nothing to show")
             return DataFrame()
 
-        # get window counts and apply min freq
+        # get window counts
         f = self.count(window).rename(columns={'freq': 'f'})
-        vocab = len(f)
-        f1 = f['f'].sum()
-        f = f.loc[f['f'] >= min_freq]
 
         # get reference frequencies
+        marginals, N = self._marginals(f, min_freq, marginals)
+
+        return self._score(
+            f, marginals, N, order=order, cut_off=cut_off, ams=ams,
+            min_freq=min_freq, frequencies=frequencies, flags=flags,
+            show_negative=show_negative
+        )
+
+    def show_windows(self, windows=[3, 5, 7], order='log_likelihood', cut_off=100,
+                     ams=None, min_freq=2, frequencies=True, flags=None,
+                     marginals='corpus', show_negative=False):
+        """Collocates in several windows.  Counts are retrieved in one pass
+        (see count_windows), marginals are retrieved once.
+
+        :return: collocates per window
+        :rtype: dict
+        """
+
+        # consistency check
+        if len(self.f1_set) == 0:
+            logger.error("nothing to show")
+            return {window: DataFrame() for window in windows}
+
+        # get window counts
+        counts = {
+            window: f.rename(columns={'freq': 'f'}) for window, f in self.count_windows(windows).items()
+        }
+
+        # get reference frequencies of all items that reach min_freq
+        # in any window
+        f = concat([f[['f']] for f in counts.values()])
+        f = f.groupby(level=f.index.names).max()
+        marginals_all, N = self._marginals(f, min_freq, marginals)
+
+        output = dict()
+        for window in windows:
+            f = counts[window]
+            if isinstance(marginals, str):
+                # restrict to items of this window
+                items = f.loc[f['f'] >= min_freq].index
+                marginals_window = marginals_all.loc[marginals_all.index.isin(items)]
+            else:
+                marginals_window = marginals_all
+            output[window] = self._score(
+                f, marginals_window, N, order=order, cut_off=cut_off, ams=ams,
+                min_freq=min_freq, frequencies=frequencies, flags=flags,
+                show_negative=show_negative
+            )
+
+        return output
+
+    def _marginals(self, f, min_freq, marginals):
+        """get reference frequencies of items with f >= min_freq and
+        reference size
+
+        """
+
         if isinstance(marginals, str):
             if marginals == 'corpus':
                 N = self.corpus.corpus_size - len(self.f1_set)
-                marginals = self.corpus.marginals(f.index, self.p_query)
+                marginals = self.corpus.marginals(f.loc[f['f'] >= min_freq].index, self.p_query)
             else:
                 raise NotImplementedError
         elif isinstance(marginals, DataFrame):
@@ -107,6 +203,19 @@ class Collocates:
         else:
             raise NotImplementedError
 
+        return marginals, N
+
+    def _score(self, f, marginals, N, order, cut_off, ams, min_freq,
+               frequencies, flags, show_negative):
+        """score window counts
+
+        """
+
+        # apply min freq
+        vocab = len(f)
+        f1 = f['f'].sum()
+        f = f.loc[f['f'] >= min_freq]
+
         # f2 = marginals - node frequencies
         f2 = marginals[['freq']].rename(columns={'freq': 'marginal'}).join(
             self.node_freq[['freq']].rename(columns={'freq': 'in_nodes'})
@@ -139,8 +248,8 @@ def dump2cooc(df_dump, context=None):
 
     strategy:
     (1a) create overlapping contexts with nodes
-    (1b) concatenate local contexts
-    (2a) sort by abs(offset)
+    (1b) calculate offsets to nodes
+    (2a) sort by cpos and abs(offset)
     (2b) deduplicate by cpos, keep first occurrences (=smallest offset)
     (3a) f1_set = (cpos where offset == 0)
     (3b) remove rows where cpos in f1_set
@@ -178,24 +287,34 @@ def dump2cooc(df_dump, context=None):
         df['end'] = df[['end', 'contextend']].min(axis=1)
 
     logger.info("(1a) create local contexts")
-    df = DataFrame.from_records(
-        node2cotext(df['match'], df['matchend'], df['context'], df['contextend'])
+    match = df['match'].values.astype(np.int64)
+    matchend = df['matchend'].values.astype(np.int64)
+    context_start = df['context'].values.astype(np.int64)
+    lengths = np.maximum(df['contextend'].values.astype(np.int64) - context_start + 1, 0)
+    starts = np.cumsum(lengths) - lengths
+    cpos = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(context_start - starts, lengths)
+    match = np.repeat(match, lengths)
+    matchend = np.repeat(matchend, lengths)
+
+    logger.info("(1b) calculate offsets")
+    offset = np.where(
+        cpos < match, cpos - match, np.where(cpos > matchend, cpos - matchend, 0)
     )
+    abs_offset = np.abs(offset)
 
-    logger.info("(1b) concatenate local contexts")
-    df_infl = DataFrame({
-        'match': list(chain.from_iterable(df['match_list'].values)),
-        'cpos': list(chain.from_iterable(df['cpos_list'].values)),
-        'offset': list(chain.from_iterable(df['offset_list'].values))
-    })
-
-    logger.info("(2a) sort by absolute offset")
-    df_infl['abs_offset'] = df_infl.offset.abs()
-    df_infl = df_infl.sort_values(by=['abs_offset', 'cpos'])
-    df_infl = df_infl.drop(["abs_offset"], axis=1)
+    logger.info("(2a) sort by cpos and absolute offset")
+    order = np.lexsort((abs_offset, cpos))
 
     logger.info("(2b) drop duplicates")
-    df_defl = df_infl.drop_duplicates(subset='cpos')
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = cpos[order[1:]] != cpos[order[:-1]]
+    keep = order[first]
+    keep = keep[np.lexsort((cpos[keep], abs_offset[keep]))]
+    df_defl = DataFrame({
+        'match': match[keep],
+        'cpos': cpos[keep],
+        'offset': offset[keep]
+    })
 
     logger.info("(3a) identify nodes ...")
     f1_set = set(df_defl.loc[df_defl['offset'] == 0]['cpos'])
@@ -12,8 +12,9 @@ from io import StringIO
 from tempfile import NamedTemporaryFile
 
 # requirements
+import numpy as np
 from association_measures import measures
-from pandas import DataFrame, MultiIndex, read_csv
+from pandas import DataFrame, MultiIndex, concat, read_csv
 
 # part of module
 from .cl import Corpus as Crps
@@ -25,7 +26,7 @@ logger = logging.getLogger(__name__)
 def count_items(items, names, tuples=True):
     """Get type frequency table of items.
 
-    :param list items: list of values or tuples
+    :param list items: list of values or tuples (or their Counter)
     :param list names: name(s) for the attributes to count
     :param bool tuples: treat each item as a tuple?
 
@@ -56,29 +57,36 @@ def count_items(items, names, tuples=True):
     return df_counts
 
 
-def read_freq_list(path, min_freq=2, columns=None):
+def read_freq_list(path, min_freq=2, columns=None, chunksize=1000000):
     """Read frequency list, e.g. output of lexdecode (see below)
 
-    :param str path: path to read from
+    The list is parsed in chunks; the frequency threshold is applied
+    to each chunk, so memory consumption is proportional to the
+    number of items retained.
+
+    :param str path: path or file-like object (e.g. stdout of a subprocess) to read from
     :param int min_freq: drop everything that doesn't appear at least this often
+    :param int chunksize: number of lines to parse at once
 
     :return: frequency list (index: item, columns: freq) and original size
     :rtype: tuple(DataFrame, int)
 
     """
 
-    # read data
+    # read data and apply frequency threshold
     logger.info('reading frequency list ...')
-    df = read_csv(path, sep="\t", header=None, quoting=3,
-                  keep_default_na=False)
-    logger.info(f'reading frequency list ... {df.shape[0]} items')
-
-    # get corpus size
-    R = df[0].sum()
-
-    # apply frequency threshold
-    logger.info('applying frequency threshold ...')
-    df = df.loc[df[0] >= min_freq]
+    R = 0
+    n = 0
+    chunks = list()
+    for chunk in read_csv(path, sep="\t", header=None, quoting=3, dtype=str,
+                          keep_default_na=False, encoding='utf-8',
+                          chunksize=chunksize):
+        chunk[0] = chunk[0].astype(np.int64)
+        R += chunk[0].sum()
+        n += len(chunk)
+        chunks.append(chunk.loc[chunk[0] >= min_freq])
+    df = concat(chunks)
+    logger.info(f'reading frequency list ... {n} items')
     logger.info(f'applying frequency threshold ... {df.shape[0]} items')
 
     # indexing
@@ -86,7 +94,7 @@ def read_freq_list(path, min_freq=2, columns=None):
     col = list(df.columns[1:]) if columns is None else columns
     df.columns = ['freq'] + col
     if len(col) > 1:
-        df['item'] = df[col].agg(' '.join, axis=1)
+        df['item'] = df[col[0]].str.cat([df[c] for c in col[1:]], sep=' ')
     else:
         df['item'] = df[col]
     df = df.set_index('item')
@@ -118,10 +126,11 @@ def cwb_lexdecode(corpus_name, registry_path,
     logger.info("running cwb-lexdecode ...")
     command = [cmd, '-f', '-P', p_att, '-r', registry_path, corpus_name]
     lexdecode = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
     )
-    ret = lexdecode.communicate()[0].decode()
-    df_counts, R = read_freq_list(StringIO(ret), min_freq=min_freq, columns=[p_att])
+    with lexdecode.stdout:
+        df_counts, R = read_freq_list(lexdecode.stdout, min_freq=min_freq, columns=[p_att])
+    lexdecode.wait()
 
     return df_counts, R
 
@@ -150,14 +159,151 @@ def cwb_scan_corpus(corpus_name, registry_path, path=None,
         command += ['-R', path]
     command += [corpus_name] + p_atts
     scan = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
     )
-    ret = scan.communicate()[0].decode()
-    df_counts, R = read_freq_list(StringIO(ret), min_freq=min_freq, columns=p_atts)
+    with scan.stdout:
+        df_counts, R = read_freq_list(scan.stdout, min_freq=min_freq, columns=p_atts)
+    scan.wait()
 
     return df_counts, R
 
 
+def cl_scan_corpus(attributes, regions=None, p_atts=['word'], min_freq=2,
+                   chunksize=2**22):
+    """Create frequency list of p-attribute(s) at corpus positions
+    in-process via CWB.CL, i.e. without the temporary file, the
+    subprocess, and the parsing of cwb_scan_corpus.
+
+    The lexicon IDs of the positions are retrieved as arrays in chunks
+    of chunksize positions, so memory consumption does not depend on
+    the number of positions; the types of each chunk (see ids2types)
+    are counted and merged with the previous chunks.  Only the distinct
+    IDs are decoded.
+
+    :param Corpus attributes: CWB.CL corpus
+    :param ndarray regions: (start, end) pairs of corpus positions (end
+                            inclusive); None = whole corpus
+    :param list p_atts: p-attribute(s) to count
+    :param int min_freq: drop everything that doesn't appear at least this often
+    :param int chunksize: number of positions retrieved at once
+
+    :return: frequency list of p-attribute values and corpus size
+    :rtype: tuple(DataFrame, int)
+
+    """
+
+    logger.info("counting in memory ...")
+    atts = [attributes.attribute(p_att, 'p') for p_att in p_atts]
+
+    # lexicon IDs of all positions, chunk by chunk
+    def iter_ids():
+        if regions is None:
+            size = atts[0].size
+            for start in range(0, size, chunksize):
+                stop = min(start + chunksize, size)
+                yield [att.range2ids(start, stop) for att in atts]
+        else:
+            starts = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+            lengths = np.maximum(starts[:, 1] - starts[:, 0] + 1, 0)
+            ends = np.cumsum(lengths)
+            starts = starts[:, 0] - (ends - lengths)
+            for start in range(0, int(ends[-1]) if len(ends) > 0 else 0, chunksize):
+                idx = np.arange(start, min(start + chunksize, ends[-1]))
+                cpos = idx + starts[np.searchsorted(ends, idx, side='right')]
+                ids = [att.cpos2ids(cpos) for att in atts]
+                valid = np.logical_and.reduce([i >= 0 for i in ids])
+                yield [i[valid] for i in ids]
+
+    # count types chunk by chunk
+    R = 0
+    types = [np.empty(0, dtype=np.int64) for att in atts]
+    freqs = np.empty(0, dtype=np.int64)
+    for ids in iter_ids():
+        R += len(ids[0])
+        chunk_types, inverse = ids2types(atts, ids)
+        chunk_freqs = np.bincount(inverse, minlength=len(chunk_types[0]))
+        # merge with previous chunks
+        types, inverse = ids2types(atts, [
+            np.concatenate([t, chunk_t]) for t, chunk_t in zip(types, chunk_types)
+        ])
+        freqs = np.bincount(
+            inverse, weights=np.concatenate([freqs, chunk_freqs]), minlength=len(types[0])
+        ).astype(np.int64)
+
+    # apply frequency threshold
+    keep = freqs >= min_freq
+    types, freqs = [t[keep] for t in types], freqs[keep]
+    logger.info(f'counting in memory ... {len(freqs)} items')
+
+    return decode_types(atts, p_atts, types, freqs), R
+
+
+def ids2types(atts, ids):
+    """Identify the distinct tuples of lexicon IDs (types).  Tuples are
+    combined into one integer key per position, which are identified
+    via bincount (small key spaces) or unique (otherwise).
+
+    :param list atts: CWB.CL p-attributes
+    :param list ids: lexicon IDs (one array per p-attribute)
+
+    :return: lexicon IDs of the types (one array per p-attribute) and
+             type of each position
+    :rtype: tuple(list, ndarray)
+
+    """
+
+    sizes = [att.lexicon_size for att in atts]
+    space = np.prod([float(size) for size in sizes])
+    if space < 2**62:
+        keys = ids[0].astype(np.int64)
+        for i, size in zip(ids[1:], sizes[1:]):
+            keys = keys * size + i
+        if len(keys) > 0 and space <= max(4 * len(keys), 2**20):
+            present = np.bincount(keys, minlength=int(space)) > 0
+            inverse = (np.cumsum(present) - 1)[keys]
+            keys = np.flatnonzero(present)
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+        types = list()
+        for size in reversed(sizes[1:]):
+            types.append(keys % size)
+            keys = keys // size
+        types.append(keys)
+        types = types[::-1]
+    else:
+        rows, inverse = np.unique(np.stack(ids, axis=1), axis=0, return_inverse=True)
+        types = [rows[:, k] for k in range(len(atts))]
+
+    return types, inverse.reshape(-1)
+
+
+def decode_types(atts, p_atts, types, freqs):
+    """Create frequency table of types given as lexicon IDs.
+
+    :param list atts: CWB.CL p-attributes
+    :param list p_atts: names of the p-attributes
+    :param list types: lexicon IDs of the types (one array per p-attribute)
+    :param ndarray freqs: frequencies of the types
+
+    :return: frequency table
+    :rtype: FreqFrame
+
+    """
+
+    df = DataFrame({'freq': np.asarray(freqs, dtype=np.int64)})
+    for p_att, att, i in zip(p_atts, atts, types):
+        df[p_att] = att.getDictionary().ids2str(i)
+    if len(p_atts) > 1:
+        df['item'] = df[p_atts[0]].str.cat([df[p] for p in p_atts[1:]], sep=' ')
+    else:
+        df['item'] = df[p_atts[0]]
+    df = df.set_index('item')
+
+    df = df.sort_values(['freq', 'item'], ascending=False)
+
+    return df
+
+
 class Counts:
     """All methods return a FreqFrame
 
@@ -171,14 +317,22 @@ class Counts:
 
     """
     def __init__(self, corpus_name,
-                 registry_path='/usr/local/share/cwb/registry/'):
+                 registry_path='/usr/local/share/cwb/registry/',
+                 attributes=None):
+        """
+        :param str corpus_name: name of corpus in CWB registry
+        :param str registry_path: /path/to/cwb/registry/
+        :param Corpus attributes: CWB.CL corpus to share attribute handles with
+        """
 
         self.corpus_name = corpus_name
         self.registry_path = registry_path
-        self.attributes = Crps(
-            self.corpus_name,
-            registry_dir=registry_path
-        )
+        if attributes is None:
+            attributes = Crps(
+                self.corpus_name,
+                registry_dir=registry_path
+            )
+        self.attributes = attributes
 
     def _cpos2patts(self, cpos, p_atts=['word'], ignore=True):
         """Retrieve p-attributes of corpus position.
@@ -201,38 +355,57 @@ class Counts:
 
         return tuple(token)
 
-    def cpos(self, cpos_list, p_atts=['word']):
+    def cpos(self, cpos_list, p_atts=['word'], strategy=2):
         """Create a frequency table for the p-attribute values of the
         cpos-list.
 
-        - strategy: split   /YES; flags  ; combo x
+        - strategy 1: split   /YES; flags  ; combo x
+        - strategy 2: split   /YES; flags  ; combo x
 
         :param list cpos_list: corpus positions to fill
         :param list p_atts: p-attribute (combinations) to count
+        :param int strategy: strategy 2 counts lexicon IDs and only
+                             decodes the distinct types
 
         :return: counts of the p_attribute (combinations) of the positions
         :rtype: FreqFrame
 
         """
-        items = [self._cpos2patts(p, p_atts=p_atts) for p in cpos_list]
-        df_counts = count_items(items, p_atts)
+
+        if strategy == 1:
+            items = [self._cpos2patts(p, p_atts=p_atts) for p in cpos_list]
+            df_counts = count_items(items, p_atts)
+
+        elif strategy == 2:
+            if isinstance(cpos_list, (set, frozenset)):
+                cpos = np.fromiter(cpos_list, dtype=np.int64, count=len(cpos_list))
+            else:
+                cpos = np.asarray(cpos_list, dtype=np.int64).reshape(-1)
+            cpos = cpos[cpos >= 0]
+            atts = [self.attributes.attribute(p_att, 'p') for p_att in p_atts]
+            types, inverse = ids2types(atts, [att.cpos2ids(cpos) for att in atts])
+            freqs = np.bincount(inverse, minlength=len(types[0]))
+            df_counts = decode_types(atts, p_atts, types, freqs)
+
         return df_counts
 
     @time_it
     def dump(self, df_dump, start='match', end='matchend',
-             p_atts=['word'], split=False, strategy=2):
+             p_atts=['word'], split=False, strategy=3):
         """Count tokens in [start .. end] (columns or index columns in df_dump).
 
         - strategy 1: split NO/YES; flags  ; combo x
         - strategy 2: split   /YES; flags  ; combo x
+        - strategy 3: split   /YES; flags  ; combo x
 
         :param list df_dump: corpus positions to fill
         :param str start: column name where to start counting
         :param str end: column name where to end counting
         :param list p_atts: p-attribute (combinations) to count
         :param bool split: token-based count? (default: MWU)
-        :param int strategy: strategy 2 (cwb-scan-corpus) is faster,
-                             does not support MWU counts though
+        :param int strategy: strategy 2 (cwb-scan-corpus) and strategy 3
+                             (in memory, fastest) do not support MWU
+                             counts
 
         :return: counts of the p_att (combin.) in the spans of two columns of the dump
         :rtype: FreqFrame
@@ -240,8 +413,8 @@ class Counts:
         """
 
         # choose strategy
-        if strategy == 2 and not split:
-            logger.warning("dump: cannot use cwb-scan-corpus for MWUs")
+        if strategy in [2, 3] and not split:
+            logger.warning("dump: cannot count MWUs with strategy %d" % strategy)
             strategy = 1
         logger.info(f"dump: strategy {strategy}")
 
@@ -276,18 +449,24 @@ class Counts:
                     self.corpus_name, self.registry_path, f.name, p_atts
                 )
 
+        elif strategy == 3:
+            df_counts, R = cl_scan_corpus(
+                self.attributes, df_dump[[start, end]].values, p_atts
+            )
+
         df_counts = df_counts.sort_values(by=['freq', 'item'], ascending=False)
 
         return df_counts
 
     @time_it
-    def matches(self, cqp, name, p_atts=["word"], split=False, flags=None, strategy=3):
+    def matches(self, cqp, name, p_atts=["word"], split=False, flags=None, strategy=4):
         """Counts tokens in [match .. matchend] of named subcorpus defined in
         running cqp.
 
         - strategy 1: split NO/   ; flags x; combo
         - strategy 2: split NO/YES; flags x; combo
         - strategy 3: split   /YES; flags  ; combo x
+        - strategy 4: split   /YES; flags  ; combo x
 
         :param CQP cqp: running cqp process
         :param list name: name of the subcorpus
@@ -312,13 +491,15 @@ class Counts:
         # 2: x x -
         # 3: x - -
         # 3: x - x
+        # 4: x - -
+        # 4: x - x
 
         # implemented:
         #    - - - 1,2
         #    - x - 1,2
-        #    x - - 2,3
+        #    x - - 2,3,4
         #    x x - 2
-        #    x - x 3
+        #    x - x 3,4
 
         # not implemented:
         #    - - x
@@ -346,10 +527,10 @@ class Counts:
                     "matches: cannot use cqp-tabulate"
                 )
                 strategy = 3
-        if strategy == 3:
+        if strategy in [3, 4]:
             if flags or not split:
                 logger.warning(
-                    "matches: cannot use cwb-scan-corpus"
+                    "matches: cannot use cwb-scan-corpus or count in memory"
                 )
                 strategy = 2
         logger.info(f"matches: strategy {strategy}")
@@ -371,12 +552,13 @@ class Counts:
             # split NO/YES; flags NO/YES; combo NO
             # generally faster
             logger.info("... cqp is tabulating")
-            cqp_return = cqp.Exec(f'tabulate {name} match .. matchend {p_atts[0]} {flags};')
-            logger.info("... splitting tokens")
-            if split:           # split strings into tokens
-                cqp_return = cqp_return.replace(" ", "\n")
-            tokens = cqp_return.split("\n")
-            df_counts = count_items(tokens, names=[p_atts[0]], tuples=False)
+            counts = Counter()
+            for line in cqp.ExecIter(f'tabulate {name} match .. matchend {p_atts[0]} {flags};'):
+                if split:       # split strings into tokens
+                    counts.update(line.split(" "))
+                else:
+                    counts[line] += 1
+            df_counts = count_items(counts, names=[p_atts[0]], tuples=False)
 
         elif strategy == 3:
             # split YES; flags NO; combo YES
@@ -388,6 +570,14 @@ class Counts:
                     self.corpus_name, self.registry_path, f.name, p_atts
                 )
 
+        elif strategy == 4:
+            # split YES; flags NO; combo YES
+            # no subprocesses
+            df_dump = cqp.Dump(name)
+            df_counts, R = cl_scan_corpus(
+                self.attributes, df_dump.index.to_frame().values, p_atts
+            )
+
         return df_counts
 
     @time_it
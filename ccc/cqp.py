@@ -8,21 +8,25 @@ original version by Joerg Asmussen (2008)
 current version by Philipp Heinrich (2022)
 
 """
+import asyncio
+import codecs
 import logging
 import os
 import random
 import re
 import select
+import shlex
 import signal
 import subprocess
 import sys
 import threading
 import time
-from io import StringIO
+from collections import OrderedDict
 from tempfile import NamedTemporaryFile
 
 # requirements
-from pandas import DataFrame, read_csv
+import numpy as np
+from pandas import DataFrame
 
 logger = logging.getLogger(__name__)
 
@@ -30,9 +34,84 @@ logger = logging.getLogger(__name__)
 # GLOBAL CONSTANTS OF MODULE:
 CPROGRESSCONTROLCYCLE = 5   # secs between each progress control cycle
 CMAXREQUESTPROCTIME = 500   # max secs for processing a user request
+CMAXPOOLSIZE = 8            # max number of idle processes in a CQPPool
+CREADSIZE = 2**16           # bytes read from CQP's stdout at once
+CEOL = b'-::-EOL-::-'       # marks end of output of each command
+CVERSION = re.compile(
+    r'^CQP\s+(?:\w+\s+)*([0-9]+)\.([0-9]+)(?:\.b?([0-9]+))?(?:\s+(.*))?$'
+)
 
 
 # ERROR MESSAGE TYPES:
+def read_dump(path):
+    """Read result of CQP's dump command (match, matchend, target,
+    keyword per line) from file.
+
+    :param str path: path to dump file
+
+    :return: dump indexed by (match, matchend)
+    :rtype: DataFrame
+    """
+    if os.path.getsize(path) > 0:
+        positions = np.loadtxt(path, dtype=np.int64, delimiter='\t', ndmin=2)
+    else:
+        positions = np.empty((0, 4), dtype=np.int64)
+    df = DataFrame(positions, columns=["match", "matchend", "target", "keyword"])
+    df = df.set_index(["match", "matchend"])
+
+    return df
+
+
+def format_positions(positions):
+    """Format corpus positions as tab-separated lines, one row per line.
+    Numbers are right-aligned (padded with spaces), which lets us
+    create all lines at once.
+
+    :param ndarray positions: (n x k) array of integers
+
+    :return: formatted lines
+    :rtype: bytes
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return b''
+
+    negative = positions < 0
+    absolute = np.abs(positions)
+    width = len(str(absolute.max())) + int(negative.any())
+
+    out = np.full(positions.shape + (width + 1, ), ord(' '), dtype=np.uint8)
+    out[:, :, width] = ord('\t')
+    out[:, -1, width] = ord('\n')
+    for i in range(width - 1, -1, -1):
+        digits = (absolute > 0) | (i == width - 1)
+        out[:, :, i] = np.where(
+            digits, ord('0') + absolute % 10, np.where(negative, ord('-'), ord(' '))
+        )
+        negative &= digits
+        absolute //= 10
+
+    return out.tobytes()
+
+
+def write_undump(f, df, columns=[], chunksize=2**20):
+    """Write dump in format of CQP's undump command.
+
+    :param file f: binary file to write to
+    :param DataFrame df: dump indexed by (match, matchend)
+    :param list columns: additional columns to write (target, keyword)
+    :param int chunksize: number of lines to format at once
+    """
+    positions = np.column_stack(
+        [df.index.get_level_values(0), df.index.get_level_values(1)] +
+        [df[c] for c in columns]
+    ) if len(df) > 0 else np.empty((0, 2 + len(columns)), dtype=np.int64)
+    f.write(f"{len(positions)}\n".encode())
+    for start in range(0, len(positions), chunksize):
+        f.write(format_positions(positions[start: start + chunksize]))
+    f.flush()
+
+
 class ErrCQP:
     """Handle CQP error message."""
     def __init__(self, msg):
@@ -101,17 +180,23 @@ class CQP:
         progressthread.setDaemon(True)
         progressthread.start()
 
+        # stdout is read in blocks (see _read_blocks)
+        self.outpipe = self.CQP_process.stdout.fileno()
+        self.encoding = self.CQP_process.stdout.encoding
+        self.buffer = b''
+
         # "cqp -c" should print version on startup:
-        version_string = self.CQP_process.stdout.readline()
-        version_string = version_string.rstrip()  # Equivalent to Perl's chomp
-        self.CQP_process.stdout.flush()
+        while b'\n' not in self.buffer:
+            data = os.read(self.outpipe, CREADSIZE)
+            if not data:
+                break
+            self.buffer += data
+        version_string, _, self.buffer = self.buffer.partition(b'\n')
+        version_string = version_string.decode(self.encoding).rstrip()
         if print_version:
             print(version_string)
         logger.debug("CQP " + "-" * 43 + " started")
-        version_regexp = re.compile(
-            r'^CQP\s+(?:\w+\s+)*([0-9]+)\.([0-9]+)(?:\.b?([0-9]+))?(?:\s+(.*))?$'
-        )
-        match = version_regexp.match(version_string)
+        match = CVERSION.match(version_string)
         if not match:
             logger.error("CQP backend startup failed")
             sys.exit(1)
@@ -167,11 +252,11 @@ class CQP:
         # os.killpg(os.getpgid(self.CQP_process.pid), signal.SIGTERM)
         self.__del__()
 
-    def Exec(self, cmd):
-        """Execute CQP command.
+    def _send(self, cmd):
+        """Send CQP command followed by end-of-output marker.
 
-        The method takes as input a command string and sends it
-        to the CQP child process
+        :return: whether command could be sent
+        :rtype: bool
         """
         self.execStart = time.time()
         self.status = 'ok'
@@ -180,7 +265,42 @@ class CQP:
         logger.debug("CQP << " + cmd + ";")
         try:
             self.CQP_process.stdin.write(cmd + '; .EOL.;\n')
+            self.CQP_process.stdin.flush()
         except IOError:
+            return False
+        return True
+
+    def _read_blocks(self):
+        """Yield raw output of CQP in blocks until end-of-output marker.
+
+        Output is read from the pipe in large blocks, which are
+        searched for the marker; only the last few bytes (that could
+        be the start of a marker) are kept back.
+        """
+        keep = len(CEOL) - 1
+        while self.CQPrunning:
+            pos = self.buffer.find(CEOL)
+            if pos >= 0:
+                block = self.buffer[:pos]
+                self.buffer = self.buffer[pos + len(CEOL):]
+                logger.debug("CQP " + "-" * 40 + " terminated")
+                yield block
+                return
+            if len(self.buffer) > keep:
+                yield self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+            data = os.read(self.outpipe, CREADSIZE)
+            if not data:
+                break
+            self.buffer += data
+
+    def Exec(self, cmd):
+        """Execute CQP command.
+
+        The method takes as input a command string and sends it
+        to the CQP child process
+        """
+        if not self._send(cmd):
             return None
         # In CQP.pm lines are appended to a list @result.
         # This implementation prefers a string structure instead
@@ -190,24 +310,46 @@ class CQP:
         # strings which then are to be structured by the client module.
         # The server does not emit pickled data according to some
         # language dependent protocol.
-        self.CQP_process.stdin.flush()
-        result = []
-        while self.CQPrunning:
-            ln = self.CQP_process.stdout.readline()
-            ln = ln.strip()  # strip off whitespace from start and end of line
-            if re.match(r'-::-EOL-::-', ln):
-                logger.debug("CQP " + "-" * 40 + " terminated")
-                break
-            logger.debug("CQP >> " + ln)
-            if ln != '':
-                result.append(ln)
-            self.CQP_process.stdout.flush()
+        result = b''.join(self._read_blocks()).decode(self.encoding)
         self.Checkerr()
         self.execStart = None
-        result = '\n'.join(result)
+        # strip off whitespace from start and end of lines, drop empty lines
+        result = '\n'.join([ln for ln in map(str.strip, result.split('\n')) if ln != ''])
+        if logger.isEnabledFor(logging.DEBUG):
+            for ln in result.split('\n'):
+                logger.debug("CQP >> " + ln)
         result = result.rstrip()  # strip off whitespace from EOL (\n)
         return result
 
+    def ExecIter(self, cmd):
+        """Execute CQP command, yield non-empty lines of output as they
+        are read (without collecting the whole output).
+
+        If the generator is not exhausted, the remaining output is
+        discarded when it is closed.
+        """
+        if not self._send(cmd):
+            return
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        blocks = self._read_blocks()
+        rest = ''
+        try:
+            for block in blocks:
+                lines = (rest + decoder.decode(block)).split('\n')
+                rest = lines.pop()
+                for ln in lines:
+                    ln = ln.strip()
+                    if ln != '':
+                        yield ln
+            ln = (rest + decoder.decode(b'', final=True)).strip()
+            if ln != '':
+                yield ln
+        finally:
+            for block in blocks:
+                pass
+            self.Checkerr()
+            self.execStart = None
+
     def Query(self, query):
         """Execute query in safe mode (query lock)."""
         result = []
@@ -239,8 +381,7 @@ class CQP:
 
         # check first and last
         if first is None and last is None:
-            # actual dump
-            result = self.Exec('dump ' + subcorpus + ";")
+            lines = ""
 
         elif ((not isinstance(first, int) and first is not None) or
               (not isinstance(last, int) and last is not None)):
@@ -253,21 +394,21 @@ class CQP:
                              str(first) + " > last = " + str(last) +
                              ") in Dump() method")
                 sys.exit(1)
+            lines = " " + str(first) + " " + str(last)
         else:
             if first is not None and last is None:
                 last = first
             elif last is not None and first is None:
                 first = last
-            # actual dump
-            result = self.Exec(
-                'dump ' + subcorpus + " " + str(first) + " " + str(last) + ";"
-            )
+            lines = " " + str(first) + " " + str(last)
+
+        # allow for trailing semicolon in name
+        subcorpus = subcorpus.strip().rstrip(';').strip()
 
-        # convert to pandas dataframe
-        df = read_csv(StringIO(result),
-                      sep="\t", header=None, index_col=[0, 1],
-                      names=["match", "matchend", "target", "keyword"])
-        df = df.astype(int)
+        # actual dump: via file, parsed by numpy
+        with NamedTemporaryFile(mode='rb', suffix=".dump") as f:
+            self.Exec('dump ' + subcorpus + lines + ' > "' + f.name + '";')
+            df = read_dump(f.name)
 
         return df
 
@@ -281,11 +422,8 @@ class CQP:
             if 'keyword' in df.columns:
                 wth = 'with target keyword '
                 columns = ['target', 'keyword']
-        with NamedTemporaryFile(mode='wt') as f:
-            f.write(str(len(df)) + "\n")
-            df.to_csv(f, mode="a", sep="\t", columns=columns, header=None)
-            f.seek(0)
-            f.flush()
+        with NamedTemporaryFile(mode='wb') as f:
+            write_undump(f, df, columns)
             self.Exec("undump " + subcorpus + " " + wth + '< "' + f.name + '";')
 
     def Group(self, subcorpus='Last',
@@ -465,3 +603,402 @@ class CQP:
         self.Exec(f"save {name};")
         if not self.Ok():
             logger.error('invalid corpus or NQR')
+
+
+class CQPPool:
+    """Pool of warm (initialized) CQP processes.
+
+    Idle processes are kept per key (e.g. registry, corpus, library,
+    and subcorpus). Processes are checked out for exclusive use and
+    checked in again afterwards; dead processes are dropped on
+    checkout and checkin. At most max_size idle processes are kept;
+    the least recently used ones are terminated first. Processes
+    whose state is outdated (e.g. an NQR they might have loaded has
+    been saved anew) are invalidated: they are terminated right away
+    if idle, or on checkin if checked out.
+
+    """
+
+    def __init__(self, max_size=CMAXPOOLSIZE):
+        """Class constructor."""
+        self.max_size = max_size
+        self.idle = OrderedDict()  # key -> list of idle processes
+        self.busy = dict()  # id of checked out process -> key
+        self.stale = set()  # ids of checked out processes to terminate
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(processes) for processes in self.idle.values())
+
+    @staticmethod
+    def is_alive(cqp):
+        """Health check: process is running and last command succeeded."""
+        process = getattr(cqp, 'CQP_process', None)
+        return (cqp.CQPrunning and process is not None and
+                process.poll() is None and cqp.Ok())
+
+    def checkout(self, key, start):
+        """Get an idle process for key or start a new one.
+
+        :param tuple key: key of the process
+        :param callable start: starts and initializes a new process
+
+        :return: CQP process
+        :rtype: CQP
+
+        """
+        cqp = None
+        while cqp is None:
+            with self.lock:
+                processes = self.idle.get(key)
+                if not processes:
+                    break
+                cqp = processes.pop()
+                if not processes:
+                    del self.idle[key]
+            if self.is_alive(cqp):
+                logger.debug(f"checking out CQP process {cqp.CQP_process.pid}")
+            else:
+                self._terminate(cqp)
+                cqp = None
+
+        if cqp is None:
+            logger.debug("starting new CQP process for pool")
+            cqp = start()
+
+        with self.lock:
+            self.busy[id(cqp)] = key
+        return cqp
+
+    def checkin(self, key, cqp):
+        """Return process to the pool (or terminate it if dead).
+
+        :param tuple key: key of the process
+        :param CQP cqp: process
+
+        """
+        with self.lock:
+            self.busy.pop(id(cqp), None)
+            stale = id(cqp) in self.stale
+            self.stale.discard(id(cqp))
+
+        if stale or not self.is_alive(cqp):
+            self._terminate(cqp)
+            return
+
+        evicted = list()
+        with self.lock:
+            self.idle.setdefault(key, list()).append(cqp)
+            self.idle.move_to_end(key)
+            size = sum(len(processes) for processes in self.idle.values())
+            while size > self.max_size:
+                oldest = next(iter(self.idle))
+                evicted.append(self.idle[oldest].pop(0))
+                if not self.idle[oldest]:
+                    del self.idle[oldest]
+                size -= 1
+
+        for process in evicted:
+            self._terminate(process)
+
+    def discard(self, cqp):
+        """Terminate a checked out process instead of returning it.
+
+        :param CQP cqp: process
+
+        """
+        with self.lock:
+            self.busy.pop(id(cqp), None)
+            self.stale.discard(id(cqp))
+        self._terminate(cqp)
+
+    def invalidate(self, match, keep=None):
+        """Terminate idle processes whose key matches; checked out ones
+        are terminated on checkin.
+
+        :param callable match: takes a key, returns whether to invalidate
+        :param CQP keep: checked out process that stays valid
+
+        """
+        with self.lock:
+            processes = list()
+            for key in [key for key in self.idle if match(key)]:
+                processes.extend(self.idle.pop(key))
+            for idx, key in self.busy.items():
+                if match(key) and (keep is None or idx != id(keep)):
+                    self.stale.add(idx)
+        if len(processes) > 0:
+            logger.debug(f"invalidating {len(processes)} idle CQP processes")
+        for cqp in processes:
+            self._terminate(cqp)
+
+    def forget(self):
+        """Drop all idle processes without terminating them.
+
+        Used in child processes after fork: the idle processes belong
+        to the parent and share its pipes, so they must neither be
+        used nor shut down by the child.
+
+        """
+        self.lock = threading.Lock()
+        for processes in self.idle.values():
+            for cqp in processes:
+                cqp.CQPrunning = False
+        self.idle = OrderedDict()
+        self.busy = dict()
+        self.stale = set()
+
+    def clear(self):
+        """Terminate all idle processes."""
+        with self.lock:
+            processes = [cqp for lst in self.idle.values() for cqp in lst]
+            self.idle.clear()
+        for cqp in processes:
+            self._terminate(cqp)
+
+    @staticmethod
+    def _terminate(cqp):
+        try:
+            cqp.__kill__()
+        except (AttributeError, OSError, ValueError):
+            pass
+
+
+class AsyncCQP:
+    """asyncio interface to CQP.
+
+    Commands of one process are serialized; several processes can be
+    driven concurrently from one event loop. Each command has a
+    deadline (timeout in seconds); if it is exceeded or the command
+    is cancelled, the CQP process is killed and the exception is
+    propagated. Error messages are read from stderr once the output
+    of a command is complete (CQP writes them beforehand), so they
+    are attributed to the command that caused them. Use as
+
+        async with AsyncCQP(options='-c -r /path/to/registry') as cqp:
+            await cqp.exec('GERMAPARL1386')
+            df_dump = await cqp.nqr_from_query('[lemma="Horst"]')
+
+    """
+
+    def __init__(self, binary="cqp", options='-c', timeout=CMAXREQUESTPROCTIME):
+        """Class constructor (process is started by start())."""
+        self.binary = binary
+        self.options = options
+        self.timeout = timeout
+        self.process = None
+        self.buffer = b''
+        self.stderr = list()
+        self.errpipe = None
+        self.lock = None
+        self.status = 'ok'
+        self.error_message = ''
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        """Start CQP process, check version."""
+        self.lock = asyncio.Lock()
+
+        # stderr is read without blocking (see _read_stderr)
+        self.errpipe, errpipe_w = os.pipe()
+        os.set_blocking(self.errpipe, False)
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                self.binary, *shlex.split(self.options),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=errpipe_w,
+                start_new_session=True
+            )
+        except BaseException:
+            self._close_stderr()
+            raise
+        finally:
+            os.close(errpipe_w)
+        asyncio.get_running_loop().add_reader(self.errpipe, self._read_stderr)
+
+        # "cqp -c" should print version on startup:
+        try:
+            version_string = await asyncio.wait_for(
+                self.process.stdout.readline(), self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.kill()
+            self._close_stderr()
+            raise
+        version_string = version_string.decode().rstrip()
+        match = CVERSION.match(version_string)
+        if not match:
+            self.kill()
+            self._close_stderr()
+            raise RuntimeError(f"CQP backend startup failed: {version_string}")
+        self.major_version = int(match.group(1))
+        self.minor_version = int(match.group(2))
+        self.beta_version = int(match.group(3))
+        self.compile_date = match.group(4)
+        logger.debug("CQP " + "-" * 43 + " started")
+
+        # CQP defaults:
+        await self.exec('set PrettyPrint off')
+
+    def _read_stderr(self):
+        """Collect everything CQP has written to stderr so far (called
+        whenever stderr is readable, and after each command)."""
+        while self.errpipe is not None:
+            try:
+                data = os.read(self.errpipe, CREADSIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                self._close_stderr()
+                break
+            self.stderr.append(data)
+
+    def _close_stderr(self):
+
+        if self.errpipe is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.errpipe)
+            except RuntimeError:
+                pass
+            os.close(self.errpipe)
+            self.errpipe = None
+
+    async def _read_output(self):
+        """Read raw output until end-of-output marker."""
+        blocks = list()
+        while True:
+            pos = self.buffer.find(CEOL)
+            if pos >= 0:
+                blocks.append(self.buffer[:pos])
+                self.buffer = self.buffer[pos + len(CEOL):]
+                return b''.join(blocks)
+            keep = len(CEOL) - 1
+            if len(self.buffer) > keep:
+                blocks.append(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            data = await self.process.stdout.read(CREADSIZE)
+            if not data:
+                raise ConnectionError("CQP process terminated")
+            self.buffer += data
+
+    async def exec(self, cmd, timeout=None):
+        """Execute CQP command.
+
+        :param str cmd: CQP command
+        :param float timeout: deadline in seconds (default: self.timeout)
+
+        :return: non-empty lines of output
+        :rtype: str
+        """
+        timeout = self.timeout if timeout is None else timeout
+        cmd = re.sub(r';\s*$', r'', cmd.rstrip())
+        async with self.lock:
+            self.status = 'ok'
+            logger.debug("CQP << " + cmd + ";")
+            self.process.stdin.write((cmd + '; .EOL.;\n').encode())
+            try:
+                await self.process.stdin.drain()
+                result = await asyncio.wait_for(self._read_output(), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"CQP command exceeded {timeout} seconds: {cmd}")
+                self.kill()
+                raise
+            except BaseException:
+                self.kill()
+                raise
+            # error messages of this command are in the pipe by now
+            self._read_stderr()
+            if self.stderr:
+                self.status = 'error'
+                self.error_message = b''.join(self.stderr).decode(errors='replace')
+                self.stderr.clear()
+        result = result.decode()
+        return '\n'.join([ln for ln in map(str.strip, result.split('\n')) if ln != ''])
+
+    async def query(self, query, timeout=None):
+        """Execute query in safe mode (query lock)."""
+        key = str(random.randint(1, 1000000))
+        await self.exec('set QueryLock ' + key)
+        ok = self.Ok()
+        errormsg = self.error_message if not ok else ''
+        result = await self.exec(query, timeout)
+        if not self.Ok():
+            errormsg += self.error_message
+            ok = False
+        await self.exec('unlock ' + key)
+        if not self.Ok():
+            errormsg += self.error_message
+            ok = False
+        self.status = 'ok' if ok else 'error'
+        self.error_message = errormsg
+        return result
+
+    async def dump(self, subcorpus='Last', first=None, last=None, timeout=None):
+        """Dump named query result into table of corpus positions."""
+        lines = ''
+        if first is not None or last is not None:
+            first = last if first is None else first
+            last = first if last is None else last
+            lines = f' {first} {last}'
+        subcorpus = subcorpus.strip().rstrip(';').strip()
+        loop = asyncio.get_running_loop()
+        with NamedTemporaryFile(mode='rb', suffix=".dump") as f:
+            await self.exec(f'dump {subcorpus}{lines} > "{f.name}"', timeout)
+            df = await loop.run_in_executor(None, read_dump, f.name)
+        return df
+
+    async def undump(self, subcorpus='Last', df=DataFrame(), timeout=None):
+        """Undump named query result from table of corpus positions."""
+        columns = [c for c in ['target', 'keyword'] if c in df.columns]
+        if columns == ['keyword']:
+            columns = []
+        wth = 'with ' + ' '.join(columns) + ' ' if columns else ''
+        loop = asyncio.get_running_loop()
+        with NamedTemporaryFile(mode='wb') as f:
+            await loop.run_in_executor(None, write_undump, f, df, columns)
+            await self.exec(f'undump {subcorpus} {wth}< "{f.name}"', timeout)
+
+    async def nqr_from_query(self, query, name='Last', return_dump=True, timeout=None):
+        """Define NQR from query, optionally return dump (see CQP.nqr_from_query)."""
+        await self.query(f'{name}={query};', timeout)
+        if not self.Ok():
+            logger.error(f'{self.error_message}')
+            return DataFrame()
+        if return_dump:
+            return await self.dump(name, timeout=timeout)
+
+    def Ok(self):
+        """Check for CQP errors."""
+        running = self.process is not None and self.process.returncode is None
+        return running and self.status == 'ok'
+
+    def kill(self):
+        """Kill CQP process (and its process group)."""
+        if self.process is not None and self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.status = 'error'
+
+    async def close(self):
+        """Terminate CQP process."""
+        if self.process is None:
+            return
+        if self.process.returncode is None:
+            try:
+                self.process.stdin.write(b'exit;\n')
+                await asyncio.wait_for(self.process.stdin.drain(), 1)
+                await asyncio.wait_for(self.process.wait(), 1)
+            except (asyncio.TimeoutError, ConnectionError):
+                self.kill()
+                await self.process.wait()
+        self._close_stderr()
@@ -5,13 +5,15 @@
 definition of the Corpus and Corpora classes
 
 """
+import atexit
 import logging
 import os
+from contextlib import contextmanager
 from glob import glob
 from io import StringIO
 
 # requirements
-from numpy import maximum, minimum
+import numpy as np
 from pandas import DataFrame, read_csv
 from pandas.errors import EmptyDataError
 
@@ -19,8 +21,8 @@ from pandas.errors import EmptyDataError
 from .cache import Cache, generate_idx, generate_library_idx
 from .cl import Corpus as Attributes
 from .concordances import Concordance
-from .counts import Counts, cwb_scan_corpus
-from .cqp import CQP
+from .counts import Counts, cl_scan_corpus
+from .cqp import CQP, CQPPool
 from .dumps import Dump
 from .utils import (chunk_anchors, correct_anchors, dump_left_join,
                     format_roles, group_lines, preprocess_query, aggregate_matches)
@@ -28,6 +30,12 @@ from .version import __version__
 
 logger = logging.getLogger(__name__)
 
+# warm CQP processes shared by all corpora
+CQP_POOL = CQPPool()
+atexit.register(CQP_POOL.clear)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=CQP_POOL.forget)
+
 
 def decode(text):
     """savely decode a string catching common errors
@@ -228,7 +236,7 @@ class Corpus:
 
     def __init__(self, corpus_name, lib_path=None, cqp_bin='cqp',
                  registry_path='/usr/local/share/cwb/registry/',
-                 data_path=None):
+                 data_path=None, cache_size=None):
         """Establish connection to CQP and corpus attributes, set paths, read
         library.
 
@@ -245,6 +253,7 @@ class Corpus:
         :param str cqp_bin: /path/to/cqp-binary
         :param str registry_path: /path/to/cwb/registry/
         :param str data_path: /path/to/data/and/cache/
+        :param int cache_size: maximum size of cache in bytes (None = unbounded)
 
         """
 
@@ -265,16 +274,17 @@ class Corpus:
         self.attributes = Attributes(self.corpus_name, registry_dir=self.registry_path)
 
         # get corpus size
-        self.corpus_size = len(self.attributes.attribute('word', 'p'))
+        self.corpus_size = self.attributes.attribute('word', 'p').size
 
         # get available corpus attributes
         self.attributes_available = self._attributes_available()
 
         # init cache
-        self.cache = Cache(os.path.join(self.data_path, "CACHE"))
+        self.cache_size = cache_size
+        self.cache = Cache(os.path.join(self.data_path, "CACHE"), max_bytes=cache_size)
 
         # init counts
-        self.counts = Counts(self.corpus_name, self.registry_path)
+        self.counts = Counts(self.corpus_name, self.registry_path, self.attributes)
 
     def __str__(self):
         """Method for printing.
@@ -307,9 +317,8 @@ class Corpus:
 
         """
 
-        cqp = self.start_cqp()
-        defined_macros = cqp.Exec("show macro;").split("\n")
-        cqp.__kill__()
+        with self.cqp_session() as cqp:
+            defined_macros = cqp.Exec("show macro;").split("\n")
 
         return defined_macros
 
@@ -321,9 +330,8 @@ class Corpus:
 
         """
 
-        cqp = self.start_cqp()
-        defined_wordlists = cqp.Exec("show var;").split("\n")
-        cqp.__kill__()
+        with self.cqp_session() as cqp:
+            defined_wordlists = cqp.Exec("show var;").split("\n")
 
         names = sorted(
             [n.rstrip(" =") for n in defined_wordlists if n.startswith("$") and n.endswith(" =")]
@@ -341,9 +349,8 @@ class Corpus:
         """
 
         # use CQP's context descriptor
-        cqp = self.start_cqp()
-        cqp_ret = cqp.Exec('show cd;')
-        cqp.__kill__()
+        with self.cqp_session() as cqp:
+            cqp_ret = cqp.Exec('show cd;')
 
         # read as dataframe
         attributes = read_csv(
@@ -374,6 +381,88 @@ class Corpus:
             self.subcorpus
         )
 
+    @contextmanager
+    def cqp_session(self):
+        """Check out a warm CQP process from the pool (a new one is started
+        if necessary) and return it to the pool afterwards.
+
+        On checkout, the data directory is re-read (to find NQRs saved
+        by other processes). On checkin, NQRs that only exist in
+        memory are discarded, matching strategy and anchors are reset,
+        and the (sub-)corpus is re-activated. If an exception occurs
+        (during use or while resetting), the process is terminated
+        instead. Saving an NQR invalidates all other processes of the
+        corpus, since they might have loaded an older version of it.
+
+        :return: CQP process
+        :rtype: CQP
+
+        """
+
+        key = (self.registry_path, self.corpus_name, self.lib_path,
+               self.subcorpus, self.data_path, self.cqp_bin)
+        cqp = CQP_POOL.checkout(key, self.start_cqp)
+
+        try:
+            cqp.Exec(f'set DataDirectory "{self.data_path}"')
+            yield cqp
+        except BaseException:
+            CQP_POOL.discard(cqp)
+            raise
+
+        try:
+            self._reset_cqp(cqp)
+        except BaseException as e:
+            CQP_POOL.discard(cqp)
+            if not isinstance(e, Exception):
+                raise
+            logger.warning(f"could not reset CQP process, terminated it: {e}")
+            return
+
+        CQP_POOL.checkin(key, cqp)
+
+    def _save_nqr(self, cqp, name):
+        """Save NQR to disk.  Other pooled CQP processes of the corpus
+        might have loaded an older version of the NQR, so they are not
+        re-used.
+
+        :param CQP cqp: process of the current session
+        :param str name: NQR to save
+
+        """
+        cqp.nqr_save(self.corpus_name, name)
+        CQP_POOL.invalidate(
+            lambda key: (key[0], key[1], key[4]) == (
+                self.registry_path, self.corpus_name, self.data_path
+            ),
+            keep=cqp
+        )
+
+    def _reset_cqp(self, cqp):
+        """Reset state of CQP process before it is returned to the pool.
+
+        :param CQP cqp: process
+
+        """
+
+        # discard NQRs that are not saved on disk
+        unsaved = list()
+        for line in cqp.Exec("show named;").split("\n"):
+            fields = line.split("\t")
+            if len(fields) == 3 and 'd' not in fields[0]:
+                corpus, _, name = fields[1].partition(":")
+                if corpus.lower() == self.corpus_name.lower():
+                    unsaved.append(name)
+        if len(unsaved) > 0:
+            cqp.Exec("discard " + " ".join(unsaved) + ";")
+
+        # reset state
+        cqp.Exec('set MatchingStrategy "standard";')
+        cqp.Exec('set ant 0; set ank 1;')
+        cqp.Exec(self.corpus_name)
+        if self.subcorpus is not None:
+            cqp.Exec(self.subcorpus)
+
     def copy(self):
         """Get a fresh initialization of the corpus.
 
@@ -387,7 +476,8 @@ class Corpus:
             self.lib_path,
             self.cqp_bin,
             self.registry_path,
-            self.data_path
+            self.data_path,
+            self.cache_size
         )
 
     ################
@@ -407,6 +497,43 @@ class Corpus:
 
         return self.counts._cpos2patts(cpos, p_atts, ignore)
 
+    def id_stream(self, p_att='word'):
+        """Get lexicon IDs of all corpus positions as one contiguous int32
+        array, i.e. ids[cpos] is the ID of the p-attribute at cpos.
+
+        The stream is decompressed once via CWB.CL and stored in the
+        data directory; it is returned as a read-only memory map, so
+        several processes share the same pages.
+
+        :param str p_att: p-attribute to retrieve
+
+        :return: lexicon IDs
+        :rtype: memmap
+
+        """
+
+        path = os.path.join(self.data_path, p_att + "_ids.npy")
+
+        if not os.path.isfile(path):
+            logger.info(f'creating ID stream of "{p_att}"')
+            att = self.attributes.attribute(p_att, 'p')
+            size = len(att)
+            tmp = os.path.join(self.data_path, f"{p_att}_ids.{os.getpid()}.tmp.npy")
+            try:
+                ids = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32, shape=(size, ))
+                # fill in chunks to keep memory usage low
+                for start in range(0, size, 2**24):
+                    stop = min(start + 2**24, size)
+                    ids[start:stop] = att.range2ids(start, stop)
+                ids.flush()
+                del ids
+                os.replace(tmp, path)
+            except OSError:
+                logger.error(f'could not store ID stream of "{p_att}" at "{path}"')
+                return att.range2ids(0, size)
+
+        return np.load(path, mmap_mode='r')
+
     def marginals(self, items=None, p_atts=['word'], flags=0, pattern=False):
 
         # allow lazy evocation
@@ -463,7 +590,7 @@ class Corpus:
     def marginals_complex(self, items, p_atts=['word']):
         """Extract marginal frequencies for p-attribute combinations,
         e.g. ["lemma", "pos"].  0 if not in corpus.  Marginals are
-        retrieved using cwb-scan-corpus, result is cached.
+        counted in memory (see cl_scan_corpus), result is cached.
 
         :param list items: list of tuples
         :param list p_atts: list of p-attributes
@@ -475,21 +602,25 @@ class Corpus:
 
         # get all marginals for p-att combination
         identifier = "_".join(p_atts) + "_marginals"
-        df = self.cache.get(identifier)
+
+        if items is not None:
+            # preprocess tuples
+            items = [" ".join(i) for i in items] if isinstance(items[0], tuple) \
+                else items
+            # only retrieve relevant rows from cache
+            df = self.cache.get_items(identifier, items)
+        else:
+            df = self.cache.get(identifier)
+
         if df is not None:
             # get from cache if possible
             logger.info('using cached version of marginals of "%s"' % "_".join(p_atts))
         else:
             # calculate all marginals for p-att combination
-            df, R = cwb_scan_corpus(
-                self.corpus_name, self.registry_path, p_atts=p_atts, min_freq=0
-            )
+            df, R = cl_scan_corpus(self.attributes, p_atts=p_atts, min_freq=0)
             self.cache.set(identifier, df)
 
         if items is not None:
-            # preprocess tuples
-            items = [" ".join(i) for i in items] if isinstance(items[0], tuple) \
-                else items
             # select relevant rows
             df = df.reindex(items)
             df = df.fillna(0, downcast='infer')
@@ -518,6 +649,92 @@ class Corpus:
         except KeyError:
             return -1
 
+    def s_att_index(self, s_att):
+        """Get inverted index of s-attribute annotation: the distinct
+        (decoded) values in sorted order, together with offsets and
+        cwb-ids such that strucs[offsets[i]:offsets[i+1]] are the
+        regions annotated with values[i].
+
+        Note that s-attribute values are not indexed by the CWB. The
+        index is created once via CWB.CL and stored in the data
+        directory.
+
+        :param str s_att: s-attribute to index
+
+        :return: values, offsets, strucs
+        :rtype: tuple
+
+        """
+
+        path = os.path.join(self.data_path, s_att + "_index.npz")
+
+        # retrieve from disk if possible
+        if os.path.isfile(path):
+            logger.info(f'using stored index of "{s_att}"')
+            with np.load(path) as index:
+                data = index['values_data'].tobytes()
+                bounds = index['values_offsets']
+                values = np.empty(len(bounds) - 1, dtype=object)
+                values[:] = [data[i:j].decode('utf-8') for i, j in zip(bounds[:-1], bounds[1:])]
+                return values, index['offsets'], index['strucs']
+
+        # compute
+        logger.info(f'creating index of "{s_att}"')
+        raw, offsets, strucs = self.attributes.attribute(s_att, 's').value_index()
+
+        # decode; values that cannot be decoded are merged into ""
+        decoded = np.empty(len(raw), dtype=object)
+        decoded[:] = [decode(v) for v in raw]
+        values, inverse = np.unique(decoded, return_inverse=True)
+        keys = np.repeat(inverse, np.diff(offsets))
+        strucs = strucs[np.lexsort((strucs, keys))]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=len(values)), out=offsets[1:])
+
+        # save to disk (values as concatenated UTF-8 strings)
+        encoded = [v.encode('utf-8') for v in values]
+        values_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in encoded], out=values_offsets[1:])
+        values_data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        tmp = os.path.join(self.data_path, f"{s_att}_index.{os.getpid()}.tmp.npz")
+        try:
+            np.savez(tmp, values_data=values_data, values_offsets=values_offsets,
+                     offsets=offsets, strucs=strucs)
+            os.replace(tmp, path)
+        except OSError:
+            logger.error(f'could not store index of "{s_att}" at "{path}"')
+
+        return values, offsets, strucs
+
+    def values2strucs(self, s_att, values):
+        """Get cwb-ids of all regions annotated with any of the values
+        (using the inverted index of the s-attribute).
+
+        :param str s_att: s-attribute to use
+        :param set values: values of s-att annotation
+
+        :return: cwb-ids in ascending order
+        :rtype: ndarray
+
+        """
+
+        index, offsets, strucs = self.s_att_index(s_att)
+
+        # look up values
+        values = np.array([v for v in set(values) if isinstance(v, str)], dtype=object)
+        pos = np.searchsorted(index, values)
+        found = pos < len(index)
+        found[found] = index[pos[found]] == values[found]
+        pos = pos[found]
+
+        # collect regions
+        lengths = offsets[pos + 1] - offsets[pos]
+        idx = np.arange(lengths.sum()) + np.repeat(
+            offsets[pos] - (np.cumsum(lengths) - lengths), lengths
+        )
+
+        return np.sort(strucs[idx])
+
     ##############
     # subcorpora #
     ##############
@@ -528,8 +745,8 @@ class Corpus:
         :rtype: DataFrame
 
         """
-        cqp = self.start_cqp()
-        cqp_return = cqp.Exec("show named;")
+        with self.cqp_session() as cqp:
+            cqp_return = cqp.Exec("show named;")
         try:
             df = read_csv(StringIO(cqp_return), sep="\t", header=None)
             df.columns = ["storage", "corpus:subcorpus", "size"]
@@ -542,7 +759,6 @@ class Corpus:
             logger.info("no subcorpora defined")
             df = DataFrame()
 
-        cqp.__kill__()
         return df
 
     def activate_subcorpus(self, nqr=None, df_dump=None):
@@ -565,10 +781,9 @@ class Corpus:
 
             # create NQR
             if df_dump is not None:
-                cqp = self.start_cqp()
-                cqp.nqr_from_dump(df_dump, nqr)
-                cqp.nqr_save(self.corpus_name, nqr)
-                cqp.__kill__()
+                with self.cqp_session() as cqp:
+                    cqp.nqr_from_dump(df_dump, nqr)
+                    self._save_nqr(cqp, nqr)
             if nqr not in self.show_nqr()['subcorpus'].values:
                 logger.error(f'subcorpus "{nqr}" not defined)')
             else:
@@ -585,12 +800,13 @@ class Corpus:
     ##################
     # CREATING DUMPS #
     ##################
-    def dump_from_s_att(self, s_att, annotation=True):
+    def dump_from_s_att(self, s_att, annotation=True, copy=True):
         """Create s-attribute spans as DataFrame of corpus positions.
         Resulting df_dump is indexed by (match, matchend).
 
         Note that s-attribute values are not indexed by the CWB.
-        CWB.CL implementation just iterates over all annotations.
+        Spans are retrieved in one go via CWB.CL; each distinct
+        annotation is decoded only once.
 
         This method thus creates a dataframe with the
         (non-overlapping) spans encoded as matches
@@ -604,6 +820,8 @@ class Corpus:
 
         :param str s_att: s-attribute to get spans and annotation for
         :param bool annotation: whether to retrieve annotation (if present)
+        :param bool copy: set to False if the result is not modified
+                          (it might then be shared with the cache)
 
         :return: df_dump
         :rtype: DataFrame
@@ -612,7 +830,7 @@ class Corpus:
 
         # retrieve from cache if possible
         identifier = s_att + "_spans"
-        df = self.cache.get(identifier)
+        df = self.cache.get(identifier, copy=copy)
         if df is not None:
             logger.info(f'using cached version of spans of "{s_att}"')
             return df
@@ -620,22 +838,22 @@ class Corpus:
         # compute
         logger.info(f'creating dataframe of spans of "{s_att}"')
 
-        df = DataFrame(list(self.attributes.attribute(s_att, 's')))
+        start, end, codes, values = self.attributes.attribute(s_att, 's').regions()
+        df = DataFrame({
+            s_att + '_cwbid': np.arange(len(start)),
+            'match': start.astype('int64'),
+            'matchend': end.astype('int64')
+        })
 
-        # two or three columns: 0 (start), 1 (end), 2* (annotation)
+        # annotation: decode distinct values, missing values (code -1) are ""
         if annotation:
-            annotation = (2 in df.columns)  # just to make sure ...
-            if not annotation:
+            if codes is None:
                 logger.info(f's-att "{s_att}" does not have any annotation')
             else:
-                df[2] = df[2].apply(decode)
+                labels = np.array([decode(v) for v in values] + [""], dtype=object)
+                df[s_att] = labels[codes]
 
         # post-process
-        df = df.reset_index()
-        df = df.rename({'index': s_att + '_cwbid',
-                        0: 'match',
-                        1: 'matchend',
-                        2: s_att}, axis=1)
         df = df.set_index(['match', 'matchend'])
 
         # put into cache
@@ -675,9 +893,8 @@ class Corpus:
         # identify query
         if self.subcorpus is not None:
             # check subcorpus size to avoid confusion when re-naming
-            cqp = self.start_cqp()
-            sbcrpssize = cqp.Exec(f"size {self.subcorpus}")
-            cqp.__kill__()
+            with self.cqp_session() as cqp:
+                sbcrpssize = cqp.Exec(f"size {self.subcorpus}")
         else:
             sbcrpssize = None
         identifier = generate_idx([
@@ -691,136 +908,106 @@ class Corpus:
             return df_dump
 
         # init cqp and set matching strategy
-        cqp = self.start_cqp()
-        cqp.Exec(f'set MatchingStrategy "{match_strategy}";')
-
-        # get CWB version
-        if cwb_version is None:
-            cwb_version = {'major': cqp.major_version,
-                           'minor': cqp.minor_version,
-                           'patch': cqp.beta_version}
-
-        # include optional within clause
-        if s_query is None:
-            start_query = query
-        else:
-            start_query = query + ' within ' + s_query
-
-        # get anchors
-        remaining_anchors = list(chunk_anchors(anchors, 2))
-
-        # run the query
-        logger.info("running CQP query")
-
-        # first run: anchors at 0 and 1 (considering within clause)
-        cqp.Exec('set ant 0; ank 1;')
-        df_dump = cqp.nqr_from_query(
-            query=start_query,
-            name=name,
-            match_strategy=match_strategy,
-            return_dump=True,
-            propagate_error=propagate_error
-        )
-        if propagate_error and isinstance(df_dump, str):
-            return df_dump
-
-        logger.info(f"found {len(df_dump)} matches")
+        with self.cqp_session() as cqp:
+            cqp.Exec(f'set MatchingStrategy "{match_strategy}";')
 
-        # if there's nothing to return ...
-        if len(df_dump) == 0:
-            cqp.__kill__()
-            return df_dump
+            # get CWB version
+            if cwb_version is None:
+                cwb_version = {'major': cqp.major_version,
+                               'minor': cqp.minor_version,
+                               'patch': cqp.beta_version}
 
-        df_dump.columns = [0, 1]
+            # include optional within clause
+            if s_query is None:
+                start_query = query
+            else:
+                start_query = query + ' within ' + s_query
+
+            # get anchors
+            remaining_anchors = list(chunk_anchors(anchors, 2))
+
+            # run the query
+            logger.info("running CQP query")
+
+            # first run: anchors at 0 and 1 (considering within clause)
+            cqp.Exec('set ant 0; ank 1;')
+            df_dump = cqp.nqr_from_query(
+                query=start_query,
+                name=name,
+                match_strategy=match_strategy,
+                return_dump=True,
+                propagate_error=propagate_error
+            )
+            if propagate_error and isinstance(df_dump, str):
+                return df_dump
 
-        if len(remaining_anchors) > 0:
+            logger.info(f"found {len(df_dump)} matches")
 
-            # restrict subsequent queries on initial matches
-            if (cwb_version['minor'] == 5) or (cwb_version['minor'] >= 4 and cwb_version['patch'] >= 31):
-                cqp.Exec(f"Temp = <<{name}/>> ( {query} );")
-            elif cwb_version['minor'] >= 4 and cwb_version['patch'] >= 16:
-                cqp.nqr_activate(self.corpus_name, name)
-            else:
-                raise NotImplementedError("cannot work with several anchors for CWB versions older than 3.4.16")
+            # if there's nothing to return ...
+            if len(df_dump) == 0:
+                return df_dump
 
-            for pair in remaining_anchors:
+            df_dump.columns = [0, 1]
 
-                logger.info(f".. running query for anchor(s) {str(pair)}")
-                # set appropriate anchors
-                cqp.Exec(f'set ant {pair[0]};')
-                if len(pair) == 2:
-                    cqp.Exec(f'set ank {pair[1]};')
-                else:
-                    cqp.Exec('set ank 1;')
+            if len(remaining_anchors) > 0:
 
-                # dump new anchors
+                # restrict subsequent queries on initial matches
+                # (newer versions: subquery on NQR in each run below)
                 if (cwb_version['minor'] == 5) or (cwb_version['minor'] >= 4 and cwb_version['patch'] >= 31):
-                    cqp.Query(f"Temp = <<{name}/>> ( {query} );")
-                elif cwb_version['minor'] == 4 and cwb_version['patch'] >= 16:
-                    cqp.Query(f'Temp = <match> ( {query} );')
-                df = cqp.Dump("Temp")
-
-                # select columns and join to global df
-                if len(pair) == 2:
-                    df.columns = [pair[0], pair[1]]
+                    pass
+                elif cwb_version['minor'] >= 4 and cwb_version['patch'] >= 16:
+                    cqp.nqr_activate(self.corpus_name, name)
                 else:
-                    df.columns = [pair[0], 1]
-                    df = df.drop(1, axis=1)
-                df_dump = df_dump.join(df)
-
-            # NA handling
-            logger.info("post-processing dataframe")
-            # df_dump = df_dump.dropna(axis=1, how='all')
-            # it is more reasonable to yield all requested columns
-            # (even if some are all NA) -- instead of silently
-            # dropping columns
-            df_dump = df_dump.fillna(-1, downcast='infer')
-
-        # restrict output to requested anchors
-        df_dump = df_dump[anchors]
-
-        # put into cache
-        self.cache.set(identifier, df_dump)
-
-        if save:
-            cqp.nqr_save(self.corpus_name, name)
-
-        cqp.__kill__()
+                    raise NotImplementedError("cannot work with several anchors for CWB versions older than 3.4.16")
+
+                dfs = list()
+                for pair in remaining_anchors:
+
+                    logger.info(f".. running query for anchor(s) {str(pair)}")
+                    # set appropriate anchors
+                    ank = pair[1] if len(pair) == 2 else 1
+                    cqp.Exec(f'set ant {pair[0]}; set ank {ank};')
+
+                    # dump new anchors
+                    if (cwb_version['minor'] == 5) or (cwb_version['minor'] >= 4 and cwb_version['patch'] >= 31):
+                        cqp.Query(f"Temp = <<{name}/>> ( {query} );")
+                    elif cwb_version['minor'] == 4 and cwb_version['patch'] >= 16:
+                        cqp.Query(f'Temp = <match> ( {query} );')
+                    df = cqp.Dump("Temp")
+
+                    # select columns
+                    if len(pair) == 2:
+                        df.columns = [pair[0], pair[1]]
+                    else:
+                        df.columns = [pair[0], 1]
+                        df = df.drop(1, axis=1)
+                    dfs.append(df)
+
+                # join to global df at once
+                df_dump = df_dump.join(dfs)
+
+                # NA handling
+                logger.info("post-processing dataframe")
+                # df_dump = df_dump.dropna(axis=1, how='all')
+                # it is more reasonable to yield all requested columns
+                # (even if some are all NA) -- instead of silently
+                # dropping columns
+                df_dump = df_dump.fillna(-1, downcast='infer')
+
+            # restrict output to requested anchors
+            df_dump = df_dump[anchors]
+
+            # put into cache
+            self.cache.set(identifier, df_dump)
+
+            if save:
+                self._save_nqr(cqp, name)
 
         return df_dump
 
     #################################################
     # WORKING ON DUMPS ##############################
     #################################################
-    def _dump2patt_row(self, row, p_att, start, end):
-        """Retrieve p-attribute annotation from start to end of one row.
-
-        :param Series row: dataframe row that contains start and end keys
-        :param str p_att: p-attribute to retrieve
-        :param str start: key of start column (int or str)
-        :param str end: key of end column (int or str)
-
-        :return: p-attribute annotation
-        :rtype: str
-        """
-
-        # treat missing columns like missing values
-        cpos_start = row.get(start, -1)
-        cpos_end = row.get(end, -1)
-
-        # if both are missing, return empty string
-        if cpos_start == cpos_end == -1:
-            return ""
-        # if one of them is missing, set start = end or end = start
-        if cpos_start == -1:
-            cpos_start = cpos_end
-        if cpos_end == -1:
-            cpos_end = cpos_start
-
-        # lexicalize
-        p = self.attributes.attribute(p_att, 'p')
-        return " ".join(p[int(cpos_start): int(cpos_end) + 1])
-
     def dump2patt(self, df_dump, p_att='word', start='match', end='matchend'):
         """Retrieve p-attribute annotation from start to end.
 
@@ -830,6 +1017,11 @@ class Corpus:
         there are no conflicts (in which case the original column will
         be overwritten).
 
+        Missing values (-1) and missing columns are replaced by the
+        other boundary; if both are missing, the annotation is empty.
+        The lexicon IDs of all positions are retrieved at once, and
+        each type is decoded only once.
+
         :param DataFrame df_dump: DataFrame with specified columns (possibly as index)
         :param str p_att: p-attribute to retrieve
         :param str start: key of start column (int or str)
@@ -844,10 +1036,25 @@ class Corpus:
         index_names = df_dump.index.names
         df = df_dump.reset_index()
 
+        # regions
+        missing = np.full(len(df), -1, dtype=np.int64)
+        starts = df[start].values.astype(np.int64) if start in df.columns else missing
+        ends = df[end].values.astype(np.int64) if end in df.columns else missing
+        starts, ends = np.where(starts == -1, ends, starts), np.where(ends == -1, starts, ends)
+        empty = (starts == -1) & (ends == -1)
+        starts[empty], ends[empty] = 0, -1
+
         # retrieve attribute
-        df[p_att] = df.apply(
-            lambda row: self._dump2patt_row(row, p_att, start, end), axis=1
-        )
+        att = self.attributes.attribute(p_att, 'p')
+        if ((starts < 0) | (ends < starts - 1) | (ends >= att.size)).any():
+            raise IndexError('P-attribute offset out of bounds')
+        lengths = ends - starts + 1
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        cpos = np.arange(offsets[-1], dtype=np.int64) + np.repeat(starts - offsets[:-1], lengths)
+        tokens = att.getDictionary().ids2str(att.cpos2ids(cpos)).tolist()
+        df[p_att] = [
+            " ".join(tokens[i:j]) for i, j in zip(offsets[:-1], offsets[1:])
+        ]
 
         # post-process
         df = df.set_index(index_names)
@@ -883,47 +1090,33 @@ class Corpus:
         df = df_dump.reset_index()[['match', 'matchend']]
 
         # get $s_id
-        df[s_att + "_cwbid"] = df.match.apply(
-            lambda x: self.cpos2sid(x, s_att)
-        )
-        nr_missing = (df[s_att + '_cwbid'] == -1).sum()
+        s_attributes = self.attributes.attribute(s_att, "s")
+        strucs = s_attributes.cpos2strucs(df['match'].values)
+        df[s_att + "_cwbid"] = strucs.astype('int64')
+        nr_missing = (strucs == -1).sum()
         logger.info(f's-att "{s_att}" exists at {len(df)-nr_missing} of {len(df)} matches')
 
-        # retrieve where possible
-        s_attributes = self.attributes.attribute(s_att, "s")
-        df_s = df.loc[~(df[s_att + "_cwbid"] == -1)]
-        df = df.join(DataFrame(
-            index=df_s.index,
-            data=df_s[s_att + "_cwbid"].apply(lambda x: s_attributes[int(x)]).to_list()
-        ))
+        # retrieve where possible (-1 if not)
+        start, end = s_attributes.strucs2cpos(strucs)
+        df[s_att + '_span'] = start.astype('int64')
+        df[s_att + '_spanend'] = end.astype('int64')
 
-        # two or three columns: 0 (start), 1 (end), 2* (annotation)
-        if annotation:
-            annotation = (2 in df.columns)  # just to make sure ...
-            if not annotation:
+        # annotation: decode distinct values, missing regions are ""
+        if annotation and nr_missing < len(df):
+            try:
+                codes, values = s_attributes.strucs2str(strucs)
+            except TypeError:
                 logger.info(f's-att "{s_att}" does not have any annotation')
             else:
-                df[2] = df[2].apply(decode)
+                labels = np.array([decode(v) for v in values] + [""], dtype=object)
+                df[s_att] = labels[codes]
 
-        # restore original index and post-process
+        # restore original index
         df = df.set_index(['match', 'matchend'])
-        df = df.rename({0: s_att + '_span',
-                        1: s_att + '_spanend',
-                        2: s_att}, axis=1)
 
         # join to original dataframe
         df_dump = df_dump.join(df, lsuffix='_bak')
         df_dump = df_dump[[col for col in df_dump if not str(col).endswith('_bak')]]
-        if s_att + '_span' in df.columns and s_att + '_spanend' in df.columns:
-            df_dump[[
-                s_att + '_span', s_att + '_spanend'
-            ]] = df[[
-                s_att + '_span', s_att + '_spanend'
-            ]].fillna(-1, downcast='infer')
-        else:
-            df_dump[[
-                s_att + '_span', s_att + '_spanend'
-            ]] = -1
 
         return df_dump
 
@@ -975,12 +1168,12 @@ class Corpus:
             if context_left is None:
                 df['context'] = df.match
             else:
-                df['context'] = maximum(0, df.match - context_left)
+                df['context'] = np.maximum(0, df.match - context_left)
             # right
             if context_right is None:
                 df['contextend'] = df.matchend
             else:
-                df['contextend'] = minimum(
+                df['contextend'] = np.minimum(
                     self.corpus_size - 1, df.matchend + context_right
                 )
         else:
@@ -991,31 +1184,21 @@ class Corpus:
             df['contextid'] = df[context_break + '_cwbid']
 
             # replace -1 to not confuse min()
-            df[[
-                context_break + '_spanend'
-            ]] = df[[context_break + '_spanend']].replace(-1, self.corpus_size + 1)
+            spanend = df[context_break + '_spanend'].values
+            spanend = np.where(spanend == -1, self.corpus_size + 1, spanend)
 
             # left
             if context_left is None:
                 df['context'] = df[context_break + '_span']
             else:
-                df['context'] = df.match - context_left
-                df['context'] = df[[
-                    'context', context_break + '_span'
-                ]].max(axis=1)
+                df['context'] = np.maximum(
+                    df['match'].values - context_left, df[context_break + '_span'].values
+                )
             # right
             if context_right is None:
-                df['contextend'] = df[context_break + '_spanend']
+                df['contextend'] = spanend
             else:
-                df['contextend'] = df.matchend + context_right
-                df['contextend'] = df[[
-                    'contextend', context_break + '_spanend'
-                ]].min(axis=1)
-
-            # revert replacement
-            df[[
-                context_break + '_spanend'
-            ]] = df[[context_break + '_spanend']].replace(self.corpus_size + 1, -1)
+                df['contextend'] = np.minimum(df['matchend'].values + context_right, spanend)
 
         # restore original index
         df = df.set_index(['match', 'matchend'])
@@ -1039,7 +1222,8 @@ class Corpus:
 
         """
 
-        df_spans = self.dump_from_s_att(s_att)
+        # spans are only copied if they are not restricted below
+        df_spans = self.dump_from_s_att(s_att, copy=len(values) == 0)
 
         # restrict to certain values
         if len(values) > 0:
@@ -1051,15 +1235,14 @@ class Corpus:
             else:
                 values = set(values)
                 logger.info(f"restricting spans using {len(values)} values")
-                df_spans = df_spans.loc[df_spans[s_att].isin(values)]
+                df_spans = df_spans.iloc[self.values2strucs(s_att, values)]
 
         # save as NQR
         if name is not None:
             # undump the dump and save to disk
-            cqp = self.start_cqp()
-            cqp.nqr_from_dump(df_spans, name)
-            cqp.nqr_save(self.corpus_name, name)
-            cqp.__kill__()
+            with self.cqp_session() as cqp:
+                cqp.nqr_from_dump(df_spans, name)
+                self._save_nqr(cqp, name)
 
         # return proper Dump
         return Dump(self.copy(), df_spans, name_cqp=name)
@@ -1088,38 +1271,70 @@ class Corpus:
 
         """
 
-        # preprocess input
         save = False if name is None else True  # save NQR from CQP to disk?
         name = 'Last' if name is None else name  # name in CQP
+
+        df_dump = self._query_dump(
+            cqp_query, context_break, match_strategy, name, save,
+            propagate_error
+        )
+        if propagate_error and isinstance(df_dump, str):
+            return df_dump
+
+        return self._context_dump(
+            df_dump, context, context_left, context_right, context_break,
+            corrections, name, save
+        )
+
+    def _query_dump(self, cqp_query, context_break=None,
+                    match_strategy='standard', name='Last', save=False,
+                    propagate_error=False):
+        """First step of query_cqp: run the query and get the df_dump
+        (without context).  Can be run in several threads (each query
+        runs in its own CQP process).
+
+        :return: df_dump (see dump_from_query)
+        :rtype: DataFrame
+
+        """
+
+        # preprocess input
         query_dict = preprocess_query(cqp_query)
-        query = query_dict['query']
         s_query = query_dict['s_query']
-        anchors = query_dict['anchors']
         s_query = context_break if s_query is None else s_query
-        context_left = context if context_left is None else context_left
-        context_right = context if context_right is None else context_right
 
         # get dump from query
-        df_dump = self.dump_from_query(
-            query=query,
+        return self.dump_from_query(
+            query=query_dict['query'],
             s_query=s_query,
-            anchors=anchors,
+            anchors=query_dict['anchors'],
             match_strategy=match_strategy,
             name=name,
             save=save,
             propagate_error=propagate_error
         )
 
-        if propagate_error and isinstance(df_dump, str):
-            return df_dump
+    def _context_dump(self, df_dump, context=20, context_left=None,
+                      context_right=None, context_break=None,
+                      corrections=dict(), name='Last', save=False):
+        """Second step of query_cqp: extend the result of _query_dump to
+        context, correct anchors, and create the Dump.  Creates a
+        corpus, so it has to run in the main thread.
+
+        :return: dump
+        :rtype: Dump
+
+        """
+
+        context_left = context if context_left is None else context_left
+        context_right = context if context_right is None else context_right
 
         # if dump has been retrieved from cache, NQR might not exist
         if save and (self.show_nqr().empty or name not in self.show_nqr()['subcorpus'].values):
             # undump the dump and save to disk
-            cqp = self.start_cqp()
-            cqp.nqr_from_dump(df_dump, name)
-            cqp.nqr_save(self.corpus_name, name)
-            cqp.__kill__()
+            with self.cqp_session() as cqp:
+                cqp.nqr_from_dump(df_dump, name)
+                self._save_nqr(cqp, name)
 
         # empty return?
         if len(df_dump) == 0:
@@ -1189,16 +1404,16 @@ class Corpus:
         if len(topic_query) == 0:
             identifier = generate_idx([self.subcorpus, filter_queries, s_context, match_strategy], prefix='Query')
 
-            cqp = self.start_cqp()
-            cqp.Exec(f'set MatchingStrategy "{match_strategy}";')
-            size = int(cqp.Exec(f'size {identifier};'))
+            with self.cqp_session() as cqp:
+                cqp.Exec(f'set MatchingStrategy "{match_strategy}";')
+                size = int(cqp.Exec(f'size {identifier};'))
 
-            if size == 0:
-                disjunction = " | ".join(['(' + q + ')' for q in filter_queries])
-                logger.info(f'disjunction query: {disjunction}')
-                cqp.Query(f'{identifier} = {disjunction} within {s_context} expand to {s_context};')
-                logger.info(f'.. saving {identifier} in CWB binary format')
-                cqp.Exec(f'save {identifier};')
+                if size == 0:
+                    disjunction = " | ".join(['(' + q + ')' for q in filter_queries])
+                    logger.info(f'disjunction query: {disjunction}')
+                    cqp.Query(f'{identifier} = {disjunction} within {s_context} expand to {s_context};')
+                    logger.info(f'.. saving {identifier} in CWB binary format')
+                    cqp.Exec(f'save {identifier};')
 
             return identifier
 
@@ -1207,36 +1422,34 @@ class Corpus:
         filter_identifier = generate_idx([self.subcorpus, topic_query, s_context, match_strategy, filter_queries], prefix='Query')
 
         # CHECK CQP
-        cqp = self.start_cqp()
-        cqp.Exec(f'set MatchingStrategy "{match_strategy}";')
-        size = int(cqp.Exec(f'size {filter_identifier};'))
-
-        if size == 0:
-
-            # TODO: avoid saving twice if there's no filter
-            size = int(cqp.Exec(f'size {topic_identifier};'))
+        with self.cqp_session() as cqp:
+            cqp.Exec(f'set MatchingStrategy "{match_strategy}";')
+            size = int(cqp.Exec(f'size {filter_identifier};'))
 
-            logger.info(f'topic query: {topic_query}')
             if size == 0:
-                # TOPIC
-                cqp.Query(f'{topic_identifier} = {topic_query} expand to {s_context};')
-                logger.info(f'.. saving {topic_identifier} in CWB binary format')
-                cqp.Exec(f'save {topic_identifier};')
-            logger.info('.. size: ' + cqp.Exec(f'size {topic_identifier};'))
-
-            # FILTER
-            cqp.Exec(f'{filter_identifier} = {topic_identifier};')
-            for query in filter_queries:
-                logger.info(f'filter query: {query}')
-                cqp.Exec(f'{filter_identifier};')
-                cqp.Query(f'{filter_identifier} = {query} expand to {s_context};')
-                logger.info('.. size: ' + cqp.Exec(f'size {filter_identifier};'))
-
-            # SAVE
-            logger.info(f'.. saving {filter_identifier} in CWB binary format')
-            cqp.Exec(f'save {filter_identifier};')
 
-        cqp.__kill__()
+                # TODO: avoid saving twice if there's no filter
+                size = int(cqp.Exec(f'size {topic_identifier};'))
+
+                logger.info(f'topic query: {topic_query}')
+                if size == 0:
+                    # TOPIC
+                    cqp.Query(f'{topic_identifier} = {topic_query} expand to {s_context};')
+                    logger.info(f'.. saving {topic_identifier} in CWB binary format')
+                    cqp.Exec(f'save {topic_identifier};')
+                logger.info('.. size: ' + cqp.Exec(f'size {topic_identifier};'))
+
+                # FILTER
+                cqp.Exec(f'{filter_identifier} = {topic_identifier};')
+                for query in filter_queries:
+                    logger.info(f'filter query: {query}')
+                    cqp.Exec(f'{filter_identifier};')
+                    cqp.Query(f'{filter_identifier} = {query} expand to {s_context};')
+                    logger.info('.. size: ' + cqp.Exec(f'size {filter_identifier};'))
+
+                # SAVE
+                logger.info(f'.. saving {filter_identifier} in CWB binary format')
+                cqp.Exec(f'save {filter_identifier};')
 
         return filter_identifier
 
@@ -1256,32 +1469,32 @@ class Corpus:
 
             # INIT CQP
             identifier = self.quick_query(s_context, topic_query="", filter_queries=queries.values(), match_strategy=match_strategy)
-            cqp = self.start_cqp()
-
-            # init CONTEXT (TextConstellation)
-            cqp.Exec(f'cut {identifier} {cut_off};')
-            df_context = cqp.Dump(f'{identifier};')
-            dump_context = Dump(self.copy(), df_context, None)
-            dump_context = dump_context.set_context(context_break=s_context)
-            df_context = dump_context.df[['contextid']]
-            df_context = df_context.reset_index().set_index('contextid')
-
-            # HIGHLIGHT
-            cqp.Exec(f'{identifier};')
-            for name, query in queries.items():
-                cqp.Exec(f'Temp = {query};')
-                df_query = cqp.Dump('Temp;')
-                if len(df_query) > 0:
-                    dump_query = Dump(self.copy(), df_query, None)
-                    dump_query = dump_query.set_context(context_break=s_context)
-                    df_query = dump_query.df[['contextid']]
-                    df_agg = aggregate_matches(df_query, name)
-                    df_context = df_context.join(df_agg)
-                else:
-                    df_context[name] = None
-                    df_context[name + '_BOOL'] = False
-                    df_context[name + '_COUNTS'] = 0
-            cqp.__kill__()
+            with self.cqp_session() as cqp:
+
+                # init CONTEXT (TextConstellation) on a copy of the NQR
+                cqp.Exec(f'Sample = {identifier};')
+                cqp.Exec(f'cut Sample {cut_off};')
+                df_context = cqp.Dump('Sample;')
+                dump_context = Dump(self.copy(), df_context, None)
+                dump_context = dump_context.set_context(context_break=s_context)
+                df_context = dump_context.df[['contextid']]
+                df_context = df_context.reset_index().set_index('contextid')
+
+                # HIGHLIGHT
+                cqp.Exec('Sample;')
+                for name, query in queries.items():
+                    cqp.Exec(f'Temp = {query};')
+                    df_query = cqp.Dump('Temp;')
+                    if len(df_query) > 0:
+                        dump_query = Dump(self.copy(), df_query, None)
+                        dump_query = dump_query.set_context(context_break=s_context)
+                        df_query = dump_query.df[['contextid']]
+                        df_agg = aggregate_matches(df_query, name)
+                        df_context = df_context.join(df_agg)
+                    else:
+                        df_context[name] = None
+                        df_context[name + '_BOOL'] = False
+                        df_context[name + '_COUNTS'] = 0
 
             # index by CONTEXT MATCHES
             df = df_context.set_index(['match', 'matchend'])
@@ -1301,42 +1514,40 @@ class Corpus:
 
             # INIT CQP
             identifier = self.quick_query(s_context, topic_query, filter_queries.values(), match_strategy)
-            cqp = self.start_cqp()
-
-            # init CONTEXT (TextConstellation)
-            cqp.Exec(f'{identifier};')
-            df_context = cqp.Dump(f'{identifier};')
-            dump_context = Dump(self.copy(), df_context, None)
-            dump_context = dump_context.set_context(window, s_context)
-            df_context = dump_context.df[['contextid', 'context', 'contextend']]
-
-            # index by TOPIC MATCHES
-            cqp.Exec(f'Temp = {topic_query};')
-            df_query = cqp.Dump('Temp;')
-            dump_query = Dump(self.copy(), df_query, None)
-            dump_query = dump_query.set_context(window, s_context)
-            df_context = dump_left_join(df_context, dump_query.df, 'topic', drop=True, window=window)
-            df_context = df_context.set_index(['match_topic', 'matchend_topic'])
-            df_context.index.names = ['match', 'matchend']
-
-            # FILTER according to window size
-            for name, query in filter_queries.items():
-                cqp.Exec(f'Temp = {query};')
-                df_query = cqp.Dump('Temp;')
-                dump_query = Dump(self.copy(), df_query, None)
-                dump_query = dump_query.set_context(window, s_context)
-                df_context = dump_left_join(df_context, dump_query.df, name, drop=True, window=window)
-                df_context = df_context.drop([c + "_" + name for c in ['match', 'matchend', 'offset']], axis=1)
+            with self.cqp_session() as cqp:
+
+                # init CONTEXT (TextConstellation)
+                cqp.Exec(f'{identifier};')
+                df_context = cqp.Dump(f'{identifier};')
+                dump_context = Dump(self.copy(), df_context, None)
+                dump_context = dump_context.set_context(window, s_context)
+                df_context = dump_context.df[['contextid', 'context', 'contextend']]
 
-            # HIGHLIGHT
-            for name, query in highlight_queries.items():
-                cqp.Exec(f'Temp = {query};')
+                # index by TOPIC MATCHES
+                cqp.Exec(f'Temp = {topic_query};')
                 df_query = cqp.Dump('Temp;')
                 dump_query = Dump(self.copy(), df_query, None)
                 dump_query = dump_query.set_context(window, s_context)
-                df_context = dump_left_join(df_context, dump_query.df, name, drop=False, window=window)
-
-            cqp.__kill__()
+                df_context = dump_left_join(df_context, dump_query.df, 'topic', drop=True, window=window)
+                df_context = df_context.set_index(['match_topic', 'matchend_topic'])
+                df_context.index.names = ['match', 'matchend']
+
+                # FILTER according to window size
+                for name, query in filter_queries.items():
+                    cqp.Exec(f'Temp = {query};')
+                    df_query = cqp.Dump('Temp;')
+                    dump_query = Dump(self.copy(), df_query, None)
+                    dump_query = dump_query.set_context(window, s_context)
+                    df_context = dump_left_join(df_context, dump_query.df, name, drop=True, window=window)
+                    df_context = df_context.drop([c + "_" + name for c in ['match', 'matchend', 'offset']], axis=1)
+
+                # HIGHLIGHT
+                for name, query in highlight_queries.items():
+                    cqp.Exec(f'Temp = {query};')
+                    df_query = cqp.Dump('Temp;')
+                    dump_query = Dump(self.copy(), df_query, None)
+                    dump_query = dump_query.set_context(window, s_context)
+                    df_context = dump_left_join(df_context, dump_query.df, name, drop=False, window=window)
 
             # ACTUAL CONCORDANCING
             hkeys = list(highlight_queries.keys())
@@ -6,6 +6,7 @@ mostly support for MMDA frontend
 
 """
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # requirements
 from association_measures.measures import score
@@ -198,15 +199,11 @@ class Constellation:
             corpus=self.corpus, df_dump=None, p_query=p_show, mws=max(windows),
             df_cooc=df_cooc, f1_set=f1_set, node_freq=node_freq
         )
-        output = dict()
-        for window in windows:
-            output[window] = collocates.show(
-                window=window, order=order, cut_off=cut_off, ams=ams,
-                min_freq=min_freq, frequencies=frequencies, flags=flags,
-                marginals=marginals
-            )
-
-        return output
+        return collocates.show_windows(
+            windows=windows, order=order, cut_off=cut_off, ams=ams,
+            min_freq=min_freq, frequencies=frequencies, flags=flags,
+            marginals=marginals
+        )
 
 
 class TextConstellation:
@@ -352,8 +349,42 @@ def textual_associations(cooc, N, column):
 
 ########################################################
 # CONSTELLATION CREATION FROM DISCOURSEMES AND QUERIES
-# TODO parallelize
 ########################################################
+def query_discoursemes(corpus, queries, s_context, match_strategy='longest', workers=1):
+    """Run discourseme queries.  With several workers, the CQP queries
+    are run concurrently (each in its own CQP process); the context of
+    each match is then determined sequentially, since creating corpora
+    is not thread-safe (see ccc.cl).
+
+    :param Corpus corpus: corpus to query
+    :param list queries: (query, context) pairs
+    :param str s_context: s-attribute to confine context
+    :param str match_strategy: CQP matching strategy
+    :param int workers: number of concurrent CQP processes
+
+    :return: Dumps in the order of queries
+    :rtype: list
+    """
+
+    def query_dump(query):
+        return corpus._query_dump(
+            query, context_break=s_context, match_strategy=match_strategy
+        )
+
+    workers = min(workers, len(queries))
+    if workers > 1:
+        logger.info(f"running {len(queries)} queries on {workers} CQP processes")
+        with ThreadPoolExecutor(workers) as executor:
+            df_dumps = list(executor.map(query_dump, [query for query, context in queries]))
+    else:
+        df_dumps = [query_dump(query) for query, context in queries]
+
+    return [
+        corpus._context_dump(df_dump, context=context, context_break=s_context)
+        for df_dump, (query, context) in zip(df_dumps, queries)
+    ]
+
+
 def create_constellation(corpus_name,
                          # discoursemes
                          topic_discourseme,
@@ -374,7 +405,8 @@ def create_constellation(corpus_name,
                          registry_path='/usr/local/share/cwb/registry/',
                          data_path='/tmp/ccc-data/',
                          window=None,
-                         approximate=False):
+                         approximate=False,
+                         workers=1):
     """simple constellation creator. returns a Constellation() if a
     topic_discourseme is given, otherwise a TextConstellation(). Note
     that for TextConstellations, there is no difference between
@@ -384,6 +416,7 @@ def create_constellation(corpus_name,
     :param dict topic_discourseme: used for init
     :param dict filter_discoursemes: inner join
     :param dict additional_discourseme: left join
+    :param int workers: number of discourseme queries to run concurrently
 
     """
 
@@ -394,55 +427,50 @@ def create_constellation(corpus_name,
     # init corpus
     corpus = Corpus(corpus_name, lib_path, cqp_bin, registry_path, data_path)
 
+    def format_query(items):
+        return format_cqp_query(
+            items, p_query=p_query, s_query=s_query, flags=flags, escape=escape
+        )
+
     # topic -> Constellation()
     if len(topic_discourseme) > 0:
 
         if len(topic_discourseme) > 1:
             raise ValueError("only one topic discourseme can be given")
 
-        # init with topic
         topic_name = list(topic_discourseme.keys())[0]
-        topic_items = topic_discourseme[topic_name]
-        topic_query = format_cqp_query(
-            topic_items, p_query=p_query, s_query=s_query, flags=flags, escape=escape
-        )
-        topic_dump = corpus.query_cqp(
-            topic_query,
-            context=context,
-            context_break=s_context,
-            match_strategy=match_strategy
-        )
-        const = Constellation(topic_dump, topic_name)
+        topic_query = format_query(topic_discourseme[topic_name])
+        filter_queries = [format_query(items) for items in filter_discoursemes.values()]
+        additional_queries = [format_query(items) for items in additional_discoursemes.values()]
 
         if approximate:
+            # topic restricts subsequent queries
+            topic_dump = query_discoursemes(
+                corpus, [(topic_query, context)], s_context, match_strategy
+            )[0]
             sub = topic_dump.df.set_index(['context', 'contextend'])
             corpus = corpus.activate_subcorpus(nqr='TempRestriction', df_dump=sub)
-
-        # add filter discoursemes
-        for disc_name, disc_items in filter_discoursemes.items():
-            disc_query = format_cqp_query(
-                disc_items, p_query=p_query, s_query=s_query, flags=flags, escape=escape
+            disc_dumps = query_discoursemes(
+                corpus, [(q, None) for q in filter_queries + additional_queries],
+                s_context, match_strategy, workers
             )
-            disc_dump = corpus.query_cqp(
-                disc_query,
-                context=None,
-                context_break=s_context,
-                match_strategy=match_strategy
+        else:
+            disc_dumps = query_discoursemes(
+                corpus, [(topic_query, context)] + [(q, None) for q in filter_queries + additional_queries],
+                s_context, match_strategy, workers
             )
+            topic_dump = disc_dumps.pop(0)
+
+        # init with topic
+        const = Constellation(topic_dump, topic_name)
+
+        # add filter discoursemes
+        for disc_name, disc_dump in zip(filter_discoursemes.keys(), disc_dumps[:len(filter_queries)]):
             if len(disc_dump.df) > 0:
                 const.add_discourseme(disc_dump, disc_name, drop=True, window=window)
 
         # add additional discoursemes
-        for disc_name, disc_items in additional_discoursemes.items():
-            disc_query = format_cqp_query(
-                disc_items, p_query=p_query, s_query=s_query, flags=flags, escape=escape
-            )
-            disc_dump = corpus.query_cqp(
-                disc_query,
-                context=None,
-                context_break=s_context,
-                match_strategy=match_strategy
-            )
+        for disc_name, disc_dump in zip(additional_discoursemes.keys(), disc_dumps[len(filter_queries):]):
             if len(disc_dump.df) > 0:
                 const.add_discourseme(disc_dump, disc_name, drop=False)
 
@@ -453,32 +481,19 @@ def create_constellation(corpus_name,
 
         # no filter implemented: all discoursemes are equal
         discoursemes = {**filter_discoursemes, **additional_discoursemes}
+        queries = [format_query(items) for items in discoursemes.values()]
 
-        # init with arbitrary topic
-        topic_name = list(discoursemes.keys())[0]
-        topic_items = discoursemes.pop(topic_name)
-        topic_query = format_cqp_query(
-            topic_items, p_query=p_query, s_query=s_query, flags=flags, escape=escape
-        )
-        topic_dump = corpus.query_cqp(
-            topic_query,
-            context=context,
-            context_break=s_context,
-            match_strategy=match_strategy
+        dumps = query_discoursemes(
+            corpus, [(queries[0], context)] + [(q, None) for q in queries[1:]],
+            s_context, match_strategy, workers
         )
-        const = TextConstellation(topic_dump, s_context, topic_name)
+
+        # init with arbitrary topic
+        names = list(discoursemes.keys())
+        const = TextConstellation(dumps[0], s_context, names[0])
 
         # add further discoursemes
-        for disc_name, disc_items in discoursemes.items():
-            disc_query = format_cqp_query(
-                disc_items, p_query=p_query, s_query=s_query, flags=flags, escape=escape
-            )
-            disc_dump = corpus.query_cqp(
-                disc_query,
-                context=None,
-                context_break=s_context,
-                match_strategy=match_strategy
-            )
+        for disc_name, disc_dump in zip(names[1:], dumps[1:]):
             const.add_discourseme(disc_dump, disc_name)
 
     return const
@@ -498,7 +513,8 @@ def create_constellation_query(corpus_name,
                                cqp_bin='cqp',
                                registry_path='/usr/local/share/cwb/registry/',
                                data_path='/tmp/ccc-data/',
-                               window=None):
+                               window=None,
+                               workers=1):
     """same as above, but with pre-formatted CQP queries
 
     """
@@ -512,35 +528,21 @@ def create_constellation_query(corpus_name,
         if len(topic_discourseme) > 1:
             raise ValueError("only one topic discourseme can be given")
 
-        # init with topic
         topic_name = list(topic_discourseme.keys())[0]
-        topic_query = topic_discourseme[topic_name]
-        topic_dump = corpus.query_cqp(
-            topic_query,
-            context=context,
-            context_break=s_context,
-            match_strategy=match_strategy
-        )
-        const = Constellation(topic_dump, topic_name)
+        queries = [(topic_discourseme[topic_name], context)] + [
+            (q, None) for q in list(filter_discoursemes.values()) + list(additional_discoursemes.values())
+        ]
+        disc_dumps = query_discoursemes(corpus, queries, s_context, match_strategy, workers)
+
+        # init with topic
+        const = Constellation(disc_dumps.pop(0), topic_name)
 
         # add filter discoursemes
-        for disc_name, disc_query in filter_discoursemes.items():
-            disc_dump = corpus.query_cqp(
-                disc_query,
-                context=None,
-                context_break=s_context,
-                match_strategy=match_strategy
-            )
+        for disc_name, disc_dump in zip(filter_discoursemes.keys(), disc_dumps[:len(filter_discoursemes)]):
             const.add_discourseme(disc_dump, disc_name, drop=True, window=window)
 
         # add additional discoursemes
-        for disc_name, disc_query in additional_discoursemes.items():
-            disc_dump = corpus.query_cqp(
-                disc_query,
-                context=None,
-                context_break=s_context,
-                match_strategy=match_strategy
-            )
+        for disc_name, disc_dump in zip(additional_discoursemes.keys(), disc_dumps[len(filter_discoursemes):]):
             const.add_discourseme(disc_dump, disc_name, drop=False)
 
     # no topic -> TextConstellation()
@@ -548,26 +550,19 @@ def create_constellation_query(corpus_name,
 
         # no filter implemented: all discoursemes are equal
         discoursemes = {**filter_discoursemes, **additional_discoursemes}
+        queries = list(discoursemes.values())
 
-        # init with arbitrary topic
-        topic_name = list(discoursemes.keys())[0]
-        topic_query = discoursemes.pop(topic_name)
-        topic_dump = corpus.query_cqp(
-            topic_query,
-            context=context,
-            context_break=s_context,
-            match_strategy=match_strategy
+        dumps = query_discoursemes(
+            corpus, [(queries[0], context)] + [(q, None) for q in queries[1:]],
+            s_context, match_strategy, workers
         )
-        const = TextConstellation(topic_dump, s_context, topic_name)
+
+        # init with arbitrary topic
+        names = list(discoursemes.keys())
+        const = TextConstellation(dumps[0], s_context, names[0])
 
         # add further discoursemes
-        for disc_name, disc_query in discoursemes.items():
-            disc_dump = corpus.query_cqp(
-                disc_query,
-                context=None,
-                context_break=s_context,
-                match_strategy=match_strategy
-            )
+        for disc_name, disc_dump in zip(names[1:], dumps[1:]):
             const.add_discourseme(disc_dump, disc_name)
 
     return const
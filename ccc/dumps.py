@@ -6,6 +6,7 @@ definition of Dump and Dumps classes
 
 """
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # requirements
 from pandas import DataFrame
@@ -202,45 +203,98 @@ class Dumps:
         self.s_att = s_att
 
         logger.info("creating subcorpora ...")
-        df_spans = corpus.dump_from_s_att(s_att)
+        df_spans = corpus.dump_from_s_att(s_att, copy=False)
         dumps = dict()
         for i, s in enumerate(self.s_dict.keys()):
             logger.info(f"... subcorpus {i+1} of {len(s_dict)}")
-            df_dump = df_spans.loc[df_spans[s_att].isin(s_dict[s])]
-            dumps[s] = Dump(corpus.copy(), df_dump, name_cqp=None)
+            df_dump = df_spans.iloc[corpus.values2strucs(s_att, s_dict[s])]
+            dumps[s] = Dump(self.corpus, df_dump, name_cqp=None)
 
         self.dumps = dumps
 
+    def _load(self, p_atts, marginals=False):
+        """Load components of p-attributes before the corpus is shared
+        between threads (see ccc.cl; decoding of positions is
+        serialised per attribute).  If marginals is True, the corpus
+        marginals of combinations of p-attributes are counted and
+        cached beforehand, so that the tables don't count them in each
+        thread.
+
+        """
+        for p_att in set(p_atts + ['word']):
+            att = self.corpus.attributes.attribute(p_att, 'p')
+            att.frequency(att[0])
+        if marginals and len(p_atts) > 1:
+            self.corpus.marginals(p_atts=p_atts)
+
+    def _iter_tables(self, task, subset, workers):
+        """Yield (subcorpus_name, table) for all subcorpora in subset as
+        soon as they are computed.
+
+        """
+        if workers == 1:
+            for i, s in enumerate(subset):
+                logger.info(f"... table {i+1} of {len(subset)}")
+                yield s, task(s)
+            return
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {executor.submit(task, s): s for s in subset}
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    logger.info(f"... table {i+1} of {len(subset)}")
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def iter_keywords(self, p_query=['lemma'], order='log_likelihood', cut_off=100,
+                      ams=None, min_freq=2, frequencies=True, flags=None,
+                      subset=None, workers=1):
+        """Compute keyword tables using a pool of worker threads, see
+        keywords.
+
+        :param int workers: number of threads
+        :return: generator of (subcorpus_name, table) in order of completion
+        :rtype: generator
+        """
+
+        subset = list(self.s_dict.keys()) if subset is None else subset
+        p_query = [p_query] if isinstance(p_query, str) else p_query
+        self._load(p_query, marginals=True)
+
+        def task(s):
+            kw = Keywords(self.corpus, self.dumps[s].df, p_query)
+            return kw.show(
+                order=order, cut_off=cut_off, ams=ams, min_freq=min_freq,
+                frequencies=frequencies, flags=flags
+            )
+
+        logger.info("computing keyword tables ...")
+        yield from self._iter_tables(task, subset, workers)
+
     def keywords(self, p_query=['lemma'], order='log_likelihood', cut_off=100,
                  ams=None, min_freq=2, frequencies=True, flags=None,
-                 subset=None):
+                 subset=None, workers=1):
         """
+        :param int workers: number of threads
         :return: dictionary of {subcorpus_name: table}
         :rtype: dict
         """
 
         subset = list(self.s_dict.keys()) if subset is None else subset
+        tables = dict(self.iter_keywords(
+            p_query=p_query, order=order, cut_off=cut_off, ams=ams,
+            min_freq=min_freq, frequencies=frequencies, flags=flags,
+            subset=subset, workers=workers
+        ))
 
-        logger.info("computing keyword tables ...")
-        # TODO: multiproc
-        tables = dict()
-        i = 0
-        for s in subset:
-            i += 1
-            logger.info(f"... table {i} of {len(subset)}")
-            dump = self.dumps[s]
-            tables[s] = dump.keywords(
-                p_query=p_query, order=order, cut_off=cut_off,
-                ams=ams, min_freq=min_freq,
-                frequencies=frequencies, flags=flags
-            )
-
-        return tables
+        return {s: tables[s] for s in subset}
 
     def collocates(self, cqp_query, window=5, p_query=['lemma'],
                    order='log_likelihood', cut_off=100, ams=None, min_freq=2,
                    frequencies=True, flags=None, subset=None, context_break=None,
-                   reference='local'):
+                   reference='local', workers=1):
         """
         reference:
         .. local: window freq. compared to marginals of subcorpus (excl. nodes)
@@ -248,12 +302,37 @@ class Dumps:
         .. DataFrame:
 
         :param str reference: 'local' | 'global' | DataFrame
+        :param int workers: number of threads
         :return: dictionary of {subcorpus_name: table}
         :rtype: dict
         """
 
+        subset = list(self.s_dict.keys()) if subset is None else subset
+        tables = dict(self.iter_collocates(
+            cqp_query, window=window, p_query=p_query, order=order,
+            cut_off=cut_off, ams=ams, min_freq=min_freq,
+            frequencies=frequencies, flags=flags, subset=subset,
+            context_break=context_break, reference=reference, workers=workers
+        ))
+
+        return {s: tables[s] for s in subset}
+
+    def iter_collocates(self, cqp_query, window=5, p_query=['lemma'],
+                        order='log_likelihood', cut_off=100, ams=None, min_freq=2,
+                        frequencies=True, flags=None, subset=None, context_break=None,
+                        reference='local', workers=1):
+        """Compute collocate tables using a pool of worker threads, see
+        collocates.
+
+        :param int workers: number of threads
+        :return: generator of (subcorpus_name, table) in order of completion
+        :rtype: generator
+        """
+
         subset = list(self.s_dict.keys()) if subset is None else subset
         context_break = self.s_att if context_break is None else context_break
+        p_query = [p_query] if isinstance(p_query, str) else p_query
+        self._load(p_query, marginals=isinstance(reference, str) and reference == 'global')
 
         # run query once and extend dump
         dump_glob = self.corpus.query_cqp(
@@ -263,15 +342,10 @@ class Dumps:
         ).df
         df_glob = self.corpus.dump2satt(dump_glob, self.s_att)
 
-        logger.info("computing collocate tables ...")
-        # TODO: multiproc
-        tables = dict()
-        i = 0
-        for s in subset:
-            i += 1
-            logger.info(f"... table {i} of {len(subset)}")
+        def task(s):
 
             # determine reference frequencies
+            marginals = reference
             if isinstance(reference, str):
                 if reference == 'local':
                     # get local marginals
@@ -288,10 +362,11 @@ class Dumps:
             collocates = Collocates(
                 self.corpus, df_loc, p_query=p_query, mws=window
             )
-            tables[s] = collocates.show(
+            return collocates.show(
                 window=window, order=order, cut_off=cut_off,
                 ams=ams, min_freq=min_freq, frequencies=frequencies,
                 flags=flags, marginals=marginals
             )
 
-        return tables
+        logger.info("computing collocate tables ...")
+        yield from self._iter_tables(task, subset, workers)
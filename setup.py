@@ -89,7 +89,7 @@ setup(
         'ccc'
     ],
     ext_modules=extensions,
-    python_requires='>=3.6.2',
+    python_requires='>=3.7',
     install_requires=[
         "wheel>=0.37.1",
         "association-measures>=0.2.6",
@@ -99,12 +99,14 @@ setup(
         "unidecode>=1.3.4",
         "pyyaml>=6.0"
     ],
+    extras_require={
+        "arrow": ["pyarrow>=6.0.0"]
+    },
     classifiers=[
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
         "Development Status :: 4 - Beta",
         "Operating System :: Unix",
         "Programming Language :: Python :: 3",
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3.9',
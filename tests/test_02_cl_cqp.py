@@ -1,9 +1,13 @@
+import asyncio
+import gc
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
+import numpy as np
 from pandas import DataFrame
 
-from ccc.cl import Corpus
-from ccc.cqp import CQP
+from ccc.cl import Corpus, IDList
+from ccc.cqp import CQP, AsyncCQP, CQPPool, format_positions
 
 # import pytest
 
@@ -32,6 +36,53 @@ def test_cqp_kill():
     print()
 
 
+def test_cqp_pool(germaparl):
+
+    def start():
+        cqp = CQP(
+            binary="cqp",
+            options='-c -r ' + germaparl['registry_path']
+        )
+        cqp.Exec(germaparl['corpus_name'])
+        return cqp
+
+    pool = CQPPool(max_size=1)
+    cqp = pool.checkout('germaparl', start)
+    pid = cqp.CQP_process.pid
+    pool.checkin('germaparl', cqp)
+    assert(len(pool) == 1)
+
+    # warm process is re-used
+    cqp = pool.checkout('germaparl', start)
+    assert(cqp.CQP_process.pid == pid)
+    assert(len(pool) == 0)
+
+    # dead processes are dropped
+    cqp.__kill__()
+    pool.checkin('germaparl', cqp)
+    assert(len(pool) == 0)
+
+    # invalidated processes are terminated when idle or checked in
+    cqp = pool.checkout('germaparl', start)
+    other = pool.checkout('germaparl', start)
+    pool.invalidate(lambda key: key == 'germaparl', keep=cqp)
+    pool.checkin('germaparl', other)
+    pool.checkin('germaparl', cqp)
+    assert(len(pool) == 1)
+    assert(not other.CQPrunning and cqp.CQPrunning)
+    pool.invalidate(lambda key: key == 'germaparl')
+    assert(len(pool) == 0)
+
+    # forgotten processes (after fork) are dropped, but not shut down
+    cqp = pool.checkout('germaparl', start)
+    pool.checkin('germaparl', cqp)
+    pool.forget()
+    assert(len(pool) == 0)
+    assert(cqp.CQP_process.poll() is None)
+    cqp.CQPrunning = True
+    cqp.__kill__()
+
+
 def test_cqp_query(germaparl):
     cqp = CQP(
         binary="cqp",
@@ -41,6 +92,26 @@ def test_cqp_query(germaparl):
     cqp.Query('"Horst"')
 
 
+def test_cqp_exec_iter(germaparl):
+    cqp = CQP(
+        binary="cqp",
+        options='-c -r ' + germaparl['registry_path']
+    )
+    cqp.Exec(germaparl['corpus_name'])
+    cqp.Query('"Horst" expand to s')
+    cmd = 'tabulate Last match .. matchend word;'
+    lines = list(cqp.ExecIter(cmd))
+    assert(len(lines) == 55)
+    assert("\n".join(lines) == cqp.Exec(cmd))
+
+    # remaining output is discarded
+    it = cqp.ExecIter(cmd)
+    next(it)
+    it.close()
+    assert(cqp.Exec("size Last;") == "55")
+    cqp.__kill__()
+
+
 def test_cqp_dump(germaparl):
     cqp = CQP(
         binary="cqp",
@@ -66,6 +137,44 @@ def test_cqp_undump(germaparl):
     assert(cqp.Exec("size Test;") == str(len(df)))
 
 
+def test_format_positions():
+    positions = np.array([[0, 3, -1], [12, 150, 7]])
+    lines = format_positions(positions).decode().splitlines()
+    assert([[int(p) for p in line.split("\t")] for line in lines] == positions.tolist())
+    assert(format_positions(np.empty((0, 2))) == b'')
+
+
+def test_cqp_undump_dump(germaparl):
+    cqp = CQP(
+        binary="cqp",
+        options='-c -r ' + germaparl['registry_path']
+    )
+    cqp.Exec(germaparl['corpus_name'])
+    df = DataFrame({
+        'match': [0, 10, 20], 'matchend': [5, 12, 20], 'target': [3, -1, 20]
+    }).set_index(['match', 'matchend'])
+    cqp.Undump("Test", df)
+    dump = cqp.Dump("Test")
+    assert(list(dump.index) == list(df.index))
+    assert(list(dump['target']) == [3, -1, 20])
+    assert(list(cqp.Dump("Test", 1, 2).index) == list(df.index[1:]))
+    cqp.__kill__()
+
+
+def test_cqp_dump_semicolon(germaparl):
+    cqp = CQP(
+        binary="cqp",
+        options='-c -r ' + germaparl['registry_path']
+    )
+    cqp.Exec(germaparl['corpus_name'])
+    cqp.Query('Test = "Horst";')
+    df = cqp.Dump('Test')
+    assert(len(df) == 55)
+    assert(cqp.Dump('Test;').equals(df))
+    assert(cqp.Ok())
+    cqp.__kill__()
+
+
 def test_cqp_group(germaparl):
     cqp = CQP(
         binary="cqp",
@@ -78,6 +187,61 @@ def test_cqp_group(germaparl):
     assert(int(counts.split("\t")[-1]) == 11)
 
 
+def test_async_cqp(germaparl):
+
+    async def query(lemma):
+        async with AsyncCQP(options='-c -r ' + germaparl['registry_path']) as cqp:
+            await cqp.exec(germaparl['corpus_name'])
+            df = await cqp.nqr_from_query(f'[lemma="{lemma}"]', name='Test')
+            await cqp.undump('Copy', df)
+            return len(df), int(await cqp.exec('size Copy'))
+
+    async def main():
+        return await asyncio.gather(*[query(lemma) for lemma in ['Horst', 'Seehofer']])
+
+    results = asyncio.run(main())
+    assert(results[0] == (55, 55))
+    assert(results[1][0] == results[1][1] > 0)
+
+
+def test_async_cqp_errors(germaparl):
+
+    async def main():
+        async with AsyncCQP(options='-c -r ' + germaparl['registry_path']) as cqp:
+            await cqp.exec(germaparl['corpus_name'])
+            invalid = DataFrame(
+                data={'match': [0, 10], 'matchend': [10, 9]}
+            ).set_index(['match', 'matchend'])
+            valid = DataFrame(
+                data={'match': [0, 2], 'matchend': [3, 4]}
+            ).set_index(['match', 'matchend'])
+            status = list()
+            for i in range(20):
+                await cqp.undump('Test', invalid if i % 2 == 0 else valid)
+                status.append(cqp.Ok())
+            return status
+
+    # errors are attributed to the command that caused them
+    assert(asyncio.run(main()) == [False, True] * 10)
+
+
+def test_async_cqp_timeout(germaparl):
+
+    async def main():
+        cqp = AsyncCQP(options='-c -r ' + germaparl['registry_path'])
+        await cqp.start()
+        await cqp.exec(germaparl['corpus_name'])
+        try:
+            await cqp.exec('[word=".*"] [word=".*"]* [word="Horst"]', timeout=0.001)
+        except asyncio.TimeoutError:
+            pass
+        ok = cqp.Ok()
+        await cqp.close()
+        return ok
+
+    assert(not asyncio.run(main()))
+
+
 def test_nqr_from_query(germaparl):
     cqp = CQP(
         binary="cqp",
@@ -128,6 +292,174 @@ def test_cl(germaparl):
     assert(words[s_1234[0]] == "Die")
 
 
+def test_cl_cpos2ids(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+    words = corpus.attribute('word', 'p')
+
+    # bulk lookup agrees with single lookups
+    cpos = list(range(21678, 21689))
+    ids = words.cpos2ids(cpos)
+    assert(ids.dtype == np.int32)
+    assert(list(ids) == [words.cpos2id(c) for c in cpos])
+    assert((words.range2ids(21678, 21689) == ids).all())
+
+    # positions outside the corpus
+    assert(list(words.cpos2ids([-1, len(words)])) == [-1, -1])
+
+
+def test_cl_ids2str(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+    words = corpus.attribute('word', 'p')
+    lexicon = words.getDictionary()
+
+    ids = words.range2ids(21678, 21689)
+    assert(list(lexicon.ids2str(ids)) == words[21678:21689])
+    assert(list(lexicon.ids2str([-1])) == [None])
+
+
+def test_cl_idlist_numpy(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+    words = corpus.attribute('word', 'p')
+
+    # zero-copy view
+    horst = words.find('Horst')
+    cpos = np.asarray(horst)
+    assert(len(cpos) == len(horst) == 55)
+    assert(list(cpos) == list(horst))
+
+    # wrapping arrays and set operations
+    first = IDList.from_array(cpos[:10])
+    assert(list(np.asarray(horst & first)) == list(cpos[:10]))
+    assert(list(np.asarray(horst - cpos[:10])) == list(cpos[10:]))
+    assert(len(first | cpos[5:20]) == 20)
+
+
+def test_cl_regions(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+
+    # without annotation
+    sentences = corpus.attribute('s', 's')
+    start, end, codes, values = sentences.regions()
+    assert(len(start) == len(end) == 11364)
+    assert((start[1234], end[1234]) == sentences[1234][:2])
+    assert(codes is None and values is None)
+
+    # with annotation
+    texts = corpus.attribute('text_id', 's')
+    start, end, codes, values = texts.regions()
+    assert(len(values) == len(set(values)))
+    for i in range(len(texts)):
+        assert((start[i], end[i], values[codes[i]]) == texts[i])
+
+
+def test_cl_cpos2strucs(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+    sentences = corpus.attribute('s', 's')
+
+    strucs = sentences.cpos2strucs([21678, 21688, -1])
+    assert(list(strucs) == [1234, 1234, -1])
+    start, end = sentences.strucs2cpos(strucs)
+    assert(list(start) == [21678, 21678, -1])
+    assert(list(end) == [21688, 21688, -1])
+
+
+def test_cl_value_index(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+    parties = corpus.attribute('text_party', 's')
+
+    values, offsets, strucs = parties.value_index()
+    assert(values == sorted(values))
+    assert(offsets[-1] == len(strucs) == len(parties))
+    for i, value in enumerate(values):
+        assert(all(parties[s][2] == value for s in strucs[offsets[i]:offsets[i+1]]))
+
+    # find_all uses the index
+    assert(parties.find_all([b'CDU', b'CSU']) == [
+        s for s in range(len(parties)) if parties[s][2] in (b'CDU', b'CSU')
+    ])
+    assert(parties.find_all([b'CDU', b'CSU', b'CDU']) == parties.find_all([b'CDU', b'CSU']))
+
+
+def test_cl_handles(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+
+    # handles are shared
+    words = corpus.attribute('word', 'p')
+    assert(corpus.attribute('word', 'p') is words)
+    sentences = corpus.attribute('s', 's')
+    assert(corpus.attribute('s', 's') is sentences)
+
+    # metadata
+    assert(words.size == len(words) == 149800)
+    assert(words.lexicon_size == len(words.getDictionary()))
+    assert(sentences.size == len(sentences) == 11364)
+    assert(not sentences.has_values)
+    assert(corpus.attribute('text_party', 's').has_values)
+
+    # handles do not refer back to the corpus (no reference cycle),
+    # but keep the CL corpus alive
+    gc.collect()
+    gc.disable()
+    try:
+        del corpus
+        assert(gc.collect() == 0)
+        assert(list(words.getDictionary().ids2str(words.range2ids(0, 9))) == words[0:9])
+    finally:
+        gc.enable()
+
+
+def test_cl_threads(germaparl):
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_dir=germaparl['registry_path'])
+    words = corpus.attribute('word', 'p')
+    sentences = corpus.attribute('s', 's')
+
+    # load components before sharing the attributes
+    expected = words[21678:21689]
+    horst = words.find('Horst')
+    expected_strucs = list(sentences.map_idlist(horst))
+
+    def work(i):
+        return (words[21678:21689], list(sentences.map_idlist(horst)),
+                len(words.find_pattern('Horst.*') | horst))
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(work, range(16)))
+    assert(all(r[0] == expected for r in results))
+    assert(all(r[1] == expected_strucs for r in results))
+    assert(len(set(r[2] for r in results)) == 1)
+
+    # decoding the compressed token stream: many blocks, concurrently
+    cpos = np.random.default_rng(0).permutation(len(words))[:20000]
+    expected_ids = words.cpos2ids(cpos)
+
+    # handles of different Corpus objects share the CL attribute
+    handles = [
+        Corpus(germaparl['corpus_name'], registry_dir=germaparl['registry_path']).attribute('word', 'p')
+        for i in range(4)
+    ]
+
+    def decode(i):
+        chunks = np.array_split(np.roll(cpos, 1000 * i), 20)
+        ids = np.concatenate([handles[i % 4].cpos2ids(chunk) for chunk in chunks])
+        return (
+            np.array_equal(np.roll(ids, -1000 * i), expected_ids),
+            [words[int(c)] for c in cpos[i::100]] == [words[int(c):int(c) + 1][0] for c in cpos[i::100]],
+            np.array_equal(words.range2ids(i * 1000, len(words)), words.range2ids(0, len(words))[i * 1000:])
+        )
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(decode, range(16)))
+    assert(all(all(r) for r in results))
+
+
 def test_nqr_from_dump_error(germaparl):
     cqp = CQP(
         binary="cqp",
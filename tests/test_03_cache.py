@@ -3,7 +3,8 @@ from random import randint
 
 from pandas import DataFrame
 
-from ccc.cache import Cache, generate_idx, generate_library_idx
+from ccc.cache import (MEMORY_CACHE, Cache, MemoryCache, generate_idx,
+                       generate_library_idx)
 
 from .conftest import DATA_PATH
 
@@ -37,3 +38,137 @@ def test_set_get():
 
 def test_generate_library_idx(germaparl):
     assert isinstance(generate_library_idx(germaparl['lib_path']), str)
+
+
+def test_size_bounded(tmp_path):
+
+    cache = Cache(os.path.join(tmp_path, 'test-cache'), max_bytes=3500)
+    for key in ['a', 'b', 'c']:
+        cache.set(key, 'x' * 1000)
+    assert(cache.get('a') is not None)
+
+    # least recently used entry is evicted
+    cache.set('d', 'x' * 1000)
+    assert(cache.get('b') is None)
+    assert(cache.get('a') is not None)
+    assert(cache.get('d') is not None)
+
+    # too large to store at all
+    cache.set('e', 'x' * 5000)
+    assert(cache.get('e') is None)
+
+
+def test_corrupt(tmp_path):
+
+    cache = Cache(os.path.join(tmp_path, 'test-cache'))
+    cache.set('testtest', {'query': "test"})
+    with cache._connect() as con:
+        con.execute("UPDATE cache SET value = ? WHERE key = ?", (b'garbage', 'testtest'))
+    assert(cache.get('testtest') is None)
+
+    # entry is dropped and can be set again
+    cache.set('testtest', DataFrame())
+    assert(cache.get('testtest').empty)
+
+    # DataFrames saved as files
+    with cache._connect() as con:
+        frame = con.execute("SELECT frame FROM cache WHERE key = 'testtest'").fetchone()[0]
+    assert(frame is not None)
+    with open(os.path.join(cache.frame_dir, frame), 'wb') as f:
+        f.write(b'garbage')
+    MEMORY_CACHE.clear()
+    assert(cache.get('testtest') is None)
+
+
+def test_get_items(tmp_path):
+
+    cache = Cache(os.path.join(tmp_path, 'test-cache'))
+    df = DataFrame({
+        'item': ['a', 'b', 'c'], 'freq': [5, 3, 1]
+    }).set_index('item')
+    assert(cache.get_items('marginals', ['a']) is None)
+
+    cache.set('marginals', df)
+    assert(cache.get('marginals').equals(df))
+    r = cache.get_items('marginals', ['c', 'a', 'x'])
+    assert(list(r.index) == ['a', 'c'])
+    assert(list(r['freq']) == [5, 1])
+
+    # dumps with non-string column names
+    dump = DataFrame({
+        'match': [0, 5], 'matchend': [1, 7], 0: [0, -1]
+    }).set_index(['match', 'matchend'])
+    cache.set('dump', dump)
+    assert(cache.get('dump').equals(dump))
+
+
+def test_memory_cache(tmp_path):
+
+    path = os.path.join(tmp_path, 'test-cache')
+    df = DataFrame({'item': ['a', 'b'], 'freq': [2, 1]}).set_index('item')
+    Cache(path).set('marginals', df)
+
+    # shared by all caches of the same path; returns copies
+    hits = MEMORY_CACHE.stats()['hits']
+    r = Cache(path).get('marginals')
+    assert(MEMORY_CACHE.stats()['hits'] == hits + 1)
+    r['freq'] = 0
+    assert(Cache(path).get('marginals').equals(df))
+    assert(list(Cache(path).get_items('marginals', ['b'])['freq']) == [1])
+
+    # invalidated by changes on disk
+    cache = Cache(path)
+    with cache._connect() as con:
+        con.execute("UPDATE cache SET created = 0 WHERE key = 'marginals'")
+    misses = MEMORY_CACHE.stats()['misses']
+    assert(cache.get('marginals').equals(df))
+    assert(MEMORY_CACHE.stats()['misses'] == misses + 1)
+    cache.delete('marginals')
+    assert(cache.get('marginals') is None)
+
+
+def test_memory_cache_accessed(tmp_path):
+
+    path = os.path.join(tmp_path, 'test-cache')
+    df = DataFrame({'freq': range(100)})
+    cache = Cache(path, max_bytes=20000)
+    cache.set('a', df)
+    cache.set('b', df)
+    with cache._connect() as con:
+        accessed = dict(con.execute("SELECT key, accessed FROM cache").fetchall())
+
+    # memory hits do not write to disk ...
+    assert(cache.get('a', copy=False) is cache.get('a', copy=False))
+    with cache._connect() as con:
+        assert(dict(con.execute("SELECT key, accessed FROM cache").fetchall()) == accessed)
+
+    # ... but are saved before evicting least recently used entries
+    size = os.path.getsize(os.path.join(cache.frame_dir, os.listdir(cache.frame_dir)[0]))
+    cache.max_bytes = 2 * size + size // 2
+    cache.set('c', df)
+    MEMORY_CACHE.clear()
+    assert(cache.get('a') is not None)
+    assert(cache.get('b') is None)
+
+    # and when flushing
+    cache.get('c')
+    cache.flush()
+    with cache._connect() as con:
+        assert(con.execute("SELECT accessed FROM cache WHERE key = 'c'").fetchone()[0] >
+               con.execute("SELECT created FROM cache WHERE key = 'c'").fetchone()[0])
+
+
+def test_memory_cache_bounds():
+
+    memory = MemoryCache(max_entries=2)
+    df = DataFrame({'freq': range(100)})
+    for key in ['a', 'b', 'c']:
+        memory.set('path', key, 0, df)
+    assert(len(memory) == 2)
+    assert(memory.get('path', 'a', lambda created: True) is None)
+    assert(memory.get('path', 'c', lambda created: True) is not None)
+    assert(memory.stats()['evictions'] == 1)
+
+    memory = MemoryCache(max_bytes=100)
+    memory.set('path', 'a', 0, df)
+    assert(len(memory) == 0)
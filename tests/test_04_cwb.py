@@ -1,3 +1,4 @@
+import os
 from glob import glob
 
 import pandas as pd
@@ -59,6 +60,76 @@ def test_data_dir(germaparl):
     assert len(paths) >= 1
 
 
+@pytest.mark.init
+def test_cqp_session(germaparl):
+    corpus = get_corpus(germaparl)
+    with corpus.cqp_session() as cqp:
+        pid = cqp.CQP_process.pid
+        cqp.Exec('set MatchingStrategy "longest";')
+        cqp.Exec('Temp = [lemma="Horst"];')
+        assert int(cqp.Exec('size Temp;')) > 0
+
+    # same process, but reset
+    with corpus.cqp_session() as cqp:
+        assert cqp.CQP_process.pid == pid
+        assert int(cqp.Exec('size Temp;')) == 0
+
+
+@pytest.mark.init
+def test_cqp_session_reset_fails(germaparl, monkeypatch):
+    corpus = get_corpus(germaparl)
+
+    def reset(cqp):
+        raise ValueError("broken pipe")
+
+    monkeypatch.setattr(corpus, '_reset_cqp', reset)
+    with corpus.cqp_session() as cqp:
+        process = cqp.CQP_process
+    process.wait(timeout=5)
+    assert process.poll() is not None
+
+    monkeypatch.undo()
+    with corpus.cqp_session() as cqp:
+        assert cqp.CQP_process is not process
+
+
+@pytest.mark.init
+def test_cqp_session_nqr_saved(germaparl):
+    corpus = get_corpus(germaparl)
+
+    # warm process of subcorpus loads NQR
+    df_dump = corpus.query('[lemma="Seehofer"]').df
+    subcorpus = corpus.activate_subcorpus('Pooled', df_dump)
+    with subcorpus.cqp_session() as cqp:
+        assert int(cqp.Exec('size Pooled;')) == len(df_dump)
+
+    # NQR saved anew: no stale version
+    df_dump = corpus.query('[lemma="Horst"]').df
+    subcorpus = corpus.activate_subcorpus('Pooled', df_dump)
+    with subcorpus.cqp_session() as cqp:
+        assert int(cqp.Exec('size Pooled;')) == len(df_dump)
+
+
+@pytest.mark.init
+def test_cqp_session_fork(germaparl):
+    corpus = get_corpus(germaparl)
+    with corpus.cqp_session() as cqp:
+        pid = cqp.CQP_process.pid
+
+    child = os.fork()
+    if child == 0:
+        # child does not re-use (or shut down) the parent's processes
+        with corpus.cqp_session() as cqp:
+            same = cqp.CQP_process.pid == pid
+        os._exit(1 if same else 0)
+    _, status = os.waitpid(child, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    with corpus.cqp_session() as cqp:
+        assert cqp.CQP_process.pid == pid
+        assert cqp.Ok()
+
+
 #####################################################
 # MACROS AND WORDLISTS ##############################
 #####################################################
@@ -96,6 +167,34 @@ def test_cpos2patts(germaparl):
     assert token == ('gilt', 'VVFIN')
 
 
+@pytest.mark.attributes
+def test_id_stream(germaparl):
+    corpus = get_corpus(germaparl)
+    ids = corpus.id_stream('lemma')
+    assert len(ids) == corpus.corpus_size
+    lemmas = corpus.attributes.attribute('lemma', 'p')
+    assert ids[124345] == lemmas.cpos2id(124345)
+    # second call reads stored stream
+    assert (corpus.id_stream('lemma')[:100] == ids[:100]).all()
+
+
+@pytest.mark.attributes
+def test_values2strucs(germaparl):
+    corpus = get_corpus(germaparl)
+    df_spans = corpus.dump_from_s_att('text_party')
+    values = {"CDU", "CSU"}
+    strucs = corpus.values2strucs('text_party', values)
+    expected = df_spans.loc[df_spans['text_party'].isin(values)]
+    assert len(strucs) > 0
+    assert list(strucs) == list(expected['text_party_cwbid'])
+    assert len(corpus.values2strucs('text_party', {"no such party"})) == 0
+
+    # index values are not stored with fixed width
+    values, offsets, strucs = corpus.s_att_index('text_party')
+    assert values.dtype == object
+    assert list(corpus.s_att_index('text_party')[0]) == list(values)
+
+
 #####################################################
 # MARGINALS #########################################
 #####################################################
@@ -278,6 +377,34 @@ def test_dump_from_query_anchors(germaparl):
     assert all(elem in df_dump.columns for elem in germaparl['anchors'])
 
 
+@pytest.mark.dump
+def test_dump_from_query_anchors_positions(germaparl):
+    corpus = get_corpus(germaparl)
+    df_dump = corpus.dump_from_query(
+        query=r'@0[lemma="Horst"]? @1[lemma="Seehofer"] @2[] @3[word="xyzzy"]?',
+        anchors=[0, 1, 2, 3],
+        match_strategy='longest'
+    )
+    assert list(df_dump.columns) == [0, 1, 2, 3]
+    assert all(df_dump[anchor].dtype == 'int64' for anchor in df_dump.columns)
+    match = df_dump.index.get_level_values('match').values
+    matchend = df_dump.index.get_level_values('matchend').values
+
+    # anchors at known positions
+    seehofer = germaparl['dump'].index.get_level_values('match')
+    assert list(df_dump[1]) == list(seehofer)
+    assert (df_dump[2] == df_dump[1] + 1).all()
+    assert (df_dump[2] == matchend).all()
+
+    # missing anchors are -1
+    assert (df_dump[3] == -1).all()
+    horst = (df_dump[0] != -1).values
+    assert horst.sum() == 11
+    assert (df_dump[0].values[horst] == df_dump[1].values[horst] - 1).all()
+    assert (df_dump[0].values[horst] == match[horst]).all()
+    assert (df_dump[1].values[~horst] == match[~horst]).all()
+
+
 @pytest.mark.dump
 def test_dump_from_query_anchors_implementation(germaparl):
 
@@ -414,6 +541,20 @@ def test_dump2patt2(germaparl):
     assert 'word' in df_dump.columns
 
 
+@pytest.mark.dumpp
+def test_dump2patt_missing(germaparl):
+    corpus = get_corpus(germaparl)
+    words = corpus.attributes.attribute('word', 'p')
+    df_dump = pd.DataFrame({
+        'match': [21678, 21678, 21678, -1],
+        'matchend': [21688, -1, 21677, -1]
+    }).set_index(['match', 'matchend'])
+    df_dump = corpus.dump2patt(df_dump)
+    assert list(df_dump['word']) == [
+        " ".join(words[21678:21689]), words[21678], "", ""
+    ]
+
+
 #################################################
 # QUERY ALIASES #################################
 #################################################
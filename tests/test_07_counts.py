@@ -3,8 +3,8 @@ from tempfile import NamedTemporaryFile
 import pandas as pd
 import pytest
 
-from ccc.counts import (cwb_lexdecode, cwb_scan_corpus, read_freq_list,
-                        score_counts)
+from ccc.counts import (cl_scan_corpus, cwb_lexdecode, cwb_scan_corpus,
+                        read_freq_list, score_counts)
 from ccc.cwb import Corpus
 from ccc.utils import format_cqp_query
 
@@ -70,6 +70,14 @@ def test_cwb_scan_corpus_subcorpora(germaparl):
     cqp.__kill__()
 
 
+def test_read_freq_list_chunks(germaparl):
+
+    df1, R1 = read_freq_list(germaparl['freq_list'], columns=['lemma'])
+    df2, R2 = read_freq_list(germaparl['freq_list'], columns=['lemma'], chunksize=1000)
+    assert(R1 == R2)
+    assert(df1.equals(df2))
+
+
 @pytest.mark.marginals
 @pytest.mark.cwb_counts
 def test_cwb_scan_corpus_marginal(germaparl):
@@ -136,6 +144,16 @@ def test_count_cpos_combo(germaparl):
     assert(list(freqframe.columns) == ['freq'] + ['lemma', 'pos'])
 
 
+@pytest.mark.cwb_counts
+def test_count_cpos_strategies(germaparl):
+    corpus = get_corpus(germaparl)
+    cpos = set(range(1, 1000, 3))
+    for p_atts in [['word'], ['lemma', 'pos']]:
+        freqframe1 = corpus.counts.cpos(cpos, p_atts=p_atts, strategy=1)
+        freqframe2 = corpus.counts.cpos(cpos, p_atts=p_atts, strategy=2)
+        assert(freqframe1.equals(freqframe2))
+
+
 @pytest.mark.marginals
 @pytest.mark.mwus
 @pytest.mark.cwb_counts
@@ -319,6 +337,47 @@ def test_counts_dump_mwu_2(germaparl):
     assert(df["freq"].iloc[0] == 6)
 
 
+@pytest.mark.cwb_counts
+def test_counts_dump_mwu_3(germaparl):
+    strategy = 3
+
+    corpus = get_corpus(germaparl)
+    dump = corpus.dump_from_query('[lemma="die" %cd] [pos="N.*"]')
+
+    df = corpus.counts.dump(dump, p_atts=['word'], split=True, strategy=strategy)
+    assert(int(df["freq"]["der"]) == 3775)
+    assert(df.equals(corpus.counts.dump(dump, p_atts=['word'], split=True, strategy=2)))
+
+    df = corpus.counts.dump(dump, p_atts=['word', 'lemma'], split=True, strategy=strategy)
+    assert(int(df["freq"]["der die"]) == 3775)
+
+    # MWUs: fall back to strategy 1
+    df = corpus.counts.dump(dump, p_atts=['word'], split=False, strategy=strategy)
+    assert(df["freq"].iloc[0] > 0)
+
+
+@pytest.mark.cwb_counts
+def test_cl_scan_corpus(germaparl):
+
+    corpus = get_corpus(germaparl)
+    df1, R1 = cwb_scan_corpus(germaparl['corpus_name'], germaparl['registry_path'],
+                              p_atts=['lemma', 'pos'], min_freq=0)
+    df2, R2 = cl_scan_corpus(corpus.attributes, p_atts=['lemma', 'pos'], min_freq=0)
+    assert(R1 == R2 == 149800)
+    assert(df1['freq'].equals(df2['freq']))
+
+    # counting in chunks
+    df3, R3 = cl_scan_corpus(corpus.attributes, p_atts=['lemma', 'pos'], min_freq=0,
+                             chunksize=10000)
+    assert(R3 == R2)
+    assert(df3.equals(df2))
+    regions = [[0, 20000], [15000, 30000], [100000, 149799]]
+    df4, R4 = cl_scan_corpus(corpus.attributes, regions, p_atts=['word'], chunksize=7777)
+    df5, R5 = cl_scan_corpus(corpus.attributes, regions, p_atts=['word'])
+    assert(R4 == R5 == 84802)
+    assert(df4.equals(df5))
+
+
 @pytest.mark.cwb_counts
 @pytest.mark.count_matches
 def test_counts_matches_mwu_1(germaparl):
@@ -397,6 +456,25 @@ def test_counts_matches_mwu_3(germaparl):
     cqp.__kill__()
 
 
+@pytest.mark.cwb_counts
+@pytest.mark.count_matches
+def test_counts_matches_mwu_4(germaparl):
+    strategy = 4
+
+    corpus = get_corpus(germaparl)
+    cqp = corpus.start_cqp()
+    cqp.nqr_from_query('[lemma="Helmut"%cd] [lemma="Kohl"%cd]', name='Last')
+    df = corpus.counts.matches(cqp, 'Last', p_atts=['word'], split=True,
+                               strategy=strategy)
+    assert(df.equals(corpus.counts.matches(cqp, 'Last', p_atts=['word'], split=True,
+                                           strategy=3)))
+
+    df = corpus.counts.matches(cqp, 'Last', p_atts=['word', 'pos'], split=True,
+                               strategy=strategy)
+    assert("Helmut NE" in df.index)
+    cqp.__kill__()
+
+
 @pytest.mark.cwb_counts
 def test_counts_mwus(germaparl):
     corpus = get_corpus(germaparl)
@@ -2,7 +2,7 @@ import pandas as pd
 import pytest
 
 from ccc import Corpus
-from ccc.collocates import Collocates
+from ccc.collocates import Collocates, dump2cooc
 from ccc.keywords import Keywords
 
 from .conftest import DATA_PATH
@@ -41,6 +41,39 @@ def test_collo_combo(germaparl):
     assert(type(c) == pd.DataFrame)
 
 
+@pytest.mark.default
+def test_collo_windows(germaparl):
+    corpus = get_corpus(germaparl)
+    query = (
+        '[word="\\("] [lemma=".*"]+ [word="\\)"]'
+    )
+    df_dump = corpus.query(query).df
+    collocates = Collocates(corpus, df_dump, ['lemma', 'pos'])
+    windows = collocates.show_windows([3, 5], cut_off=None)
+    for window in [3, 5]:
+        c = collocates.show(window, cut_off=None)
+        assert c.sort_index().equals(windows[window].sort_index())
+
+
+@pytest.mark.default
+def test_collo_windows_min_freq(germaparl):
+    corpus = get_corpus(germaparl)
+    df_dump = corpus.query('[lemma="Seehofer"]').df
+    collocates = Collocates(corpus, df_dump, 'lemma')
+
+    # items that reach min_freq only in the larger window
+    counts = collocates.count_windows([1, 3])
+    larger = set(counts[3].index[counts[3]['freq'] >= 2])
+    smaller = set(counts[1].index[counts[1]['freq'] >= 2])
+    assert len(larger - smaller) > 0
+
+    windows = collocates.show_windows([1, 3], cut_off=None, min_freq=2)
+    for window in [1, 3]:
+        c = collocates.show(window, cut_off=None, min_freq=2)
+        assert c.sort_index().equals(windows[window].sort_index())
+    assert (larger - smaller).issubset(set(windows[3].index))
+
+
 @pytest.mark.fallback
 def test_query_logging(germaparl):
     corpus = get_corpus(germaparl)
@@ -179,6 +212,25 @@ def test_collocates_nodes(germaparl):
     assert("(" not in df.index)
 
 
+def test_dump2cooc():
+
+    # overlapping contexts: cpos 12 and 13 are covered by both nodes
+    df_dump = pd.DataFrame({
+        'match': [10, 14],
+        'matchend': [11, 14],
+        'context': [8, 12],
+        'contextend': [13, 16]
+    }).set_index(['match', 'matchend'])
+    df_cooc, f1_set = dump2cooc(df_dump)
+
+    assert f1_set == {10, 11, 14}
+    assert df_cooc.to_dict('list') == {
+        'match': [10, 10, 14, 14, 10, 14],
+        'cpos': [9, 12, 13, 15, 8, 16],
+        'offset': [-1, 1, -1, 1, -2, 2]
+    }
+
+
 @pytest.mark.collocates_gold
 def test_compare_counts(germaparl, ucs_counts):
     # identities that should hold between counting strategies:
@@ -239,6 +239,51 @@ def test_dumps_collocates_global(germaparl):
     assert tables['yellow'].index[0] == 'Grad'
 
 
+@pytest.mark.dumps
+def test_dumps_workers(germaparl):
+
+    # subcorpora via s-attribute values
+    parties = {
+        'green': {"GRUENE", "Bündnis 90/Die Grünen"},
+        'red': {'SPD'},
+        'black': {'CDU', 'CSU'},
+        'yellow': {'FDP'},
+        'purple': {'PDS'}
+    }
+
+    corpus = get_corpus(germaparl)
+    dumps = Dumps(corpus, parties, s_att='text_party')
+
+    # keywords: same tables, in order of subcorpora
+    tables = dumps.keywords(order='log_ratio')
+    tables_parallel = dumps.keywords(order='log_ratio', workers=4)
+    assert list(tables_parallel.keys()) == list(parties.keys())
+    for party in parties:
+        assert tables_parallel[party].equals(tables[party])
+
+    # collocates: yielded as they are completed
+    tables = dict(dumps.iter_collocates(
+        cqp_query='"Wirtschaft"', order='log_ratio', context_break='s',
+        window=20, workers=4
+    ))
+    assert set(tables.keys()) == set(parties.keys())
+    assert tables['yellow'].index[0] == 'Grad'
+
+    # combination of p-attributes: global marginals are counted once
+    corpus.cache.delete('lemma_pos_marginals')
+    tables = dumps.collocates(
+        cqp_query='"Wirtschaft"', p_query=['lemma', 'pos'], context_break='s',
+        reference='global', workers=4
+    )
+    assert corpus.cache.get('lemma_pos_marginals') is not None
+    tables_sequential = dumps.collocates(
+        cqp_query='"Wirtschaft"', p_query=['lemma', 'pos'], context_break='s',
+        reference='global'
+    )
+    for party in parties:
+        assert tables[party].equals(tables_sequential[party])
+
+
 @pytest.mark.benchmark
 def test_perf_dumps(benchmark, germaparl):
     benchmark.pedantic(test_dumps_collocates, kwargs={'germaparl': germaparl}, rounds=5, iterations=2)
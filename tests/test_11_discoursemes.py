@@ -3,7 +3,7 @@ from pandas import DataFrame
 
 from ccc import Corpus
 from ccc.discoursemes import (Constellation, TextConstellation,
-                              create_constellation)
+                              create_constellation, query_discoursemes)
 from ccc.utils import format_cqp_query
 
 from .conftest import DATA_PATH
@@ -277,6 +277,58 @@ def test_create_constellation(germaparl, discoursemes):
     assert len(const.df) == 2990
 
 
+def test_create_constellation_workers(germaparl, discoursemes):
+
+    corpus_name = germaparl['corpus_name']
+
+    parameters = discoursemes.pop('parameters')
+    topic_discourseme = {
+        'topic': discoursemes.pop('topic')
+    }
+
+    consts = [create_constellation(corpus_name,
+                                   topic_discourseme,
+                                   {},
+                                   discoursemes,
+                                   parameters['s_context'],
+                                   parameters['context'],
+                                   parameters['p_query'],
+                                   parameters['s_query'],
+                                   parameters['flags_query'],
+                                   parameters['escape_query'],
+                                   registry_path=germaparl['registry_path'],
+                                   data_path=DATA_PATH,
+                                   workers=workers) for workers in [1, 4]]
+
+    assert consts[0].df.equals(consts[1].df)
+
+
+def test_query_discoursemes_workers(germaparl):
+
+    corpus = Corpus(germaparl['corpus_name'],
+                    registry_path=germaparl['registry_path'],
+                    data_path=DATA_PATH)
+    queries = [('[lemma="Horst"]', 10), ('[lemma="gehen"]', 5),
+               ('"xyzzy"', 10)]
+    dumps = query_discoursemes(corpus, queries, 's')
+
+    # each query is run exactly once
+    calls = list()
+    dump_from_query = corpus.dump_from_query
+
+    def count_calls(**kwargs):
+        calls.append(kwargs['query'])
+        return dump_from_query(**kwargs)
+
+    corpus.dump_from_query = count_calls
+    dumps_parallel = query_discoursemes(corpus, queries, 's', workers=3)
+    assert sorted(calls) == sorted(query for query, context in queries)
+
+    for dump, dump_parallel in zip(dumps, dumps_parallel):
+        assert dump.df.equals(dump_parallel.df)
+    assert dumps_parallel[2].size == 0
+
+
 def test_create_textconstellation(germaparl, discoursemes):
 
     corpus_name = germaparl['corpus_name']